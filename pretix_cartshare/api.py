@@ -0,0 +1,153 @@
+from django.db.models import Prefetch, prefetch_related_objects
+from django_filters.rest_framework import (
+    DjangoFilterBackend, FilterSet, IsoDateTimeFilter,
+)
+from django_scopes import scopes_disabled
+from pretix.base.models import CartPosition
+from pretix.base.services.cart import CartError
+from pretix.multidomain.urlreverse import build_absolute_uri
+from rest_framework import serializers, status, viewsets
+from rest_framework.exceptions import ValidationError
+from rest_framework.mixins import CreateModelMixin, DestroyModelMixin
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+from .models import SharedCart
+from .services import (
+    create_shared_carts, delete_shared_carts, error_messages, resolve_lines,
+)
+
+
+class SharedCartPositionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CartPosition
+        fields = ('id', 'item', 'variation', 'price')
+
+
+class SharedCartSerializer(serializers.ModelSerializer):
+    positions = SharedCartPositionSerializer(many=True, read_only=True, source='prefetched_positions')
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = SharedCart
+        fields = ('cart_id', 'datetime', 'expires', 'subevent', 'total', 'position_count', 'summary', 'reserved',
+                  'release_unopened_at', 'opened', 'max_redemptions', 'redemptions', 'url', 'positions')
+
+    def get_url(self, obj):
+        return build_absolute_uri(obj.event, 'plugins:pretix_cartshare:redeem', kwargs={'id': obj.cart_id})
+
+
+class SharedCartLineSerializer(serializers.Serializer):
+    item = serializers.IntegerField()
+    variation = serializers.IntegerField(required=False, allow_null=True)
+    count = serializers.IntegerField(min_value=1, default=1)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, allow_null=True)
+
+
+class SharedCartCreateSerializer(serializers.Serializer):
+    expires = serializers.DateTimeField()
+    subevent = serializers.IntegerField(required=False, allow_null=True)
+    reserved = serializers.BooleanField(default=True)
+    release_unopened_at = serializers.DateTimeField(required=False, allow_null=True)
+    max_redemptions = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    positions = SharedCartLineSerializer(many=True, allow_empty=False)
+
+    def validate(self, data):
+        if data['reserved'] and data.get('max_redemptions'):
+            raise ValidationError('A limit of redemptions can only be set if the products are not reserved.')
+        if not data['reserved'] and data.get('release_unopened_at'):
+            raise ValidationError('A reservation can only be released if the products are reserved.')
+        return data
+
+
+with scopes_disabled():
+    class SharedCartFilter(FilterSet):
+        expires_after = IsoDateTimeFilter(field_name='expires', lookup_expr='gte')
+        expires_before = IsoDateTimeFilter(field_name='expires', lookup_expr='lt')
+
+        class Meta:
+            model = SharedCart
+            fields = []
+
+
+class SharedCartPagination(CursorPagination):
+    ordering = ('-datetime', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class SharedCartViewSet(CreateModelMixin, DestroyModelMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Lists, creates and deletes the shared carts of an event. Lists are paginated by a cursor on ``datetime`` and
+    ``id``. Creating accepts a single cart or a list of carts, which are then created in one transaction.
+    """
+    serializer_class = SharedCartSerializer
+    queryset = SharedCart.objects.none()
+    pagination_class = SharedCartPagination
+    filter_backends = (DjangoFilterBackend,)
+    filterset_class = SharedCartFilter
+    lookup_field = 'cart_id'
+    permission = 'can_view_orders'
+    write_permission = 'can_change_orders'
+
+    def get_queryset(self):
+        return SharedCart.objects.filter(event=self.request.event)
+
+    def _prefetch_positions(self, carts):
+        for sc in carts:
+            sc.event = self.request.event
+        prefetch_related_objects(carts, Prefetch(
+            'cart_positions', queryset=CartPosition.objects.order_by('pk'), to_attr='prefetched_positions'
+        ))
+        return carts
+
+    def list(self, request, *args, **kwargs):
+        page = self._prefetch_positions(self.paginate_queryset(self.filter_queryset(self.get_queryset())))
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def get_object(self):
+        return self._prefetch_positions([super().get_object()])[0]
+
+    def create(self, request, *args, **kwargs):
+        many = isinstance(request.data, list)
+        serializer = SharedCartCreateSerializer(data=request.data, many=many)
+        serializer.is_valid(raise_exception=True)
+        carts_data = serializer.validated_data if many else [serializer.validated_data]
+
+        subevent_ids = {data.get('subevent') for data in carts_data}
+        subevents = {
+            se.pk: se for se in self.request.event.subevents.filter(pk__in=subevent_ids - {None})
+        }
+        if subevent_ids - {None} - set(subevents):
+            raise ValidationError(str(error_messages['subevent']))
+
+        try:
+            # The lines are resolved once for every date, as the quotas depend on it
+            resolved = {
+                subevent_id: iter(resolve_lines(self.request.event, [
+                    (line['item'], line.get('variation'), line['count'], line.get('price'))
+                    for data in carts_data if data.get('subevent') == subevent_id for line in data['positions']
+                ], subevents.get(subevent_id)))
+                for subevent_id in subevent_ids
+            }
+            carts = [
+                (SharedCart(expires=data['expires'], reserved=data['reserved'],
+                            subevent=subevents.get(data.get('subevent')),
+                            release_unopened_at=data.get('release_unopened_at'),
+                            max_redemptions=data.get('max_redemptions')),
+                 [next(resolved[data.get('subevent')]) for line in data['positions']])
+                for data in carts_data
+            ]
+            create_shared_carts(self.request.event, carts)
+        except CartError as e:
+            raise ValidationError(str(e))
+        carts = [sc for sc, lines in carts]
+
+        carts = self._prefetch_positions(carts)
+        data = SharedCartSerializer(carts, many=True, context=self.get_serializer_context()).data
+        return Response(data if many else data[0], status=status.HTTP_201_CREATED)
+
+    def perform_destroy(self, instance):
+        delete_shared_carts(self.request.event, SharedCart.objects.filter(pk=instance.pk))
@@ -0,0 +1,103 @@
+import json
+from itertools import islice
+
+from defusedcsv import csv
+from django.core.serializers.json import DjangoJSONEncoder
+from django_scopes import scope
+
+from .models import SharedCart, SharedCartLine
+
+EXPORT_CHUNK_SIZE = 500
+
+CSV_HEADER = [
+    'cart_id', 'datetime', 'expires', 'total', 'reserved', 'max_redemptions', 'redemptions', 'position', 'item',
+    'item_name', 'variation', 'variation_name', 'count', 'price',
+]
+
+
+def iter_shared_carts(event, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields all shared carts of an event as ``(cart, positions, lines)`` tuples. Carts are read with a database
+    iterator and their positions and lines are fetched with one query per table for every ``chunk_size`` carts,
+    so memory use does not grow with the size of the event.
+    """
+    carts = SharedCart.objects.filter(event=event).order_by('pk').iterator(chunk_size=chunk_size)
+    Through = SharedCart.cart_positions.through
+    while True:
+        chunk = list(islice(carts, chunk_size))
+        if not chunk:
+            break
+
+        positions = {}
+        for link in Through.objects.filter(sharedcart_id__in=[sc.pk for sc in chunk]).select_related(
+            'cartposition__item', 'cartposition__variation'
+        ).order_by('cartposition_id'):
+            positions.setdefault(link.sharedcart_id, []).append(link.cartposition)
+
+        lines = {}
+        for line in SharedCartLine.objects.filter(
+            cart_id__in=[sc.pk for sc in chunk if not sc.reserved]
+        ).select_related('item', 'variation').order_by('pk'):
+            lines.setdefault(line.cart_id, []).append(line)
+
+        for sc in chunk:
+            yield sc, positions.get(sc.pk, []), lines.get(sc.pk, [])
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _product_row(sc, position_id, item, variation, count, price):
+    return [
+        sc.cart_id, sc.datetime.isoformat(), sc.expires.isoformat(), sc.total, sc.reserved,
+        sc.max_redemptions if sc.max_redemptions is not None else '', sc.redemptions, position_id or '', item.pk,
+        str(item.name), variation.pk if variation else '', variation.value if variation else '', count, price,
+    ]
+
+
+def export_csv(event, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields the shared carts of an event as CSV lines with one row per cart position, or per product line for
+    carts that do not reserve their products.
+    """
+    writer = csv.writer(_Echo())
+    with scope(organizer=event.organizer):
+        yield writer.writerow(CSV_HEADER)
+        for sc, positions, lines in iter_shared_carts(event, chunk_size):
+            for cp in positions:
+                yield writer.writerow(_product_row(sc, cp.pk, cp.item, cp.variation, 1, cp.price))
+            for line in lines:
+                yield writer.writerow(_product_row(sc, None, line.item, line.variation, line.count, line.price))
+
+
+def _serialize(sc, positions, lines):
+    return {
+        'cart_id': sc.cart_id,
+        'datetime': sc.datetime,
+        'expires': sc.expires,
+        'total': sc.total,
+        'reserved': sc.reserved,
+        'max_redemptions': sc.max_redemptions,
+        'redemptions': sc.redemptions,
+        'positions': [
+            {'id': cp.pk, 'item': cp.item_id, 'variation': cp.variation_id, 'price': cp.price}
+            for cp in positions
+        ],
+        'lines': [
+            {'item': line.item_id, 'variation': line.variation_id, 'count': line.count, 'price': line.price}
+            for line in lines
+        ],
+    }
+
+
+def export_json(event, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields the shared carts of an event as a JSON list, one cart at a time.
+    """
+    with scope(organizer=event.organizer):
+        yield '['
+        for i, (sc, positions, lines) in enumerate(iter_shared_carts(event, chunk_size)):
+            yield (',' if i else '') + json.dumps(_serialize(sc, positions, lines), cls=DjangoJSONEncoder)
+        yield ']'
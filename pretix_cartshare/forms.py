@@ -1,25 +1,156 @@
+import csv
+import io
+import json
+from datetime import datetime, time
+from decimal import Decimal, InvalidOperation
+
 from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.forms import BaseFormSet, formset_factory
-from django.utils.translation import ugettext_lazy as _
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.timezone import make_aware
+from django.utils.translation import (
+    get_language, pgettext_lazy, ugettext_lazy as _,
+)
 from django_scopes import scopes_disabled
+from pretix.base.forms.widgets import DatePickerWidget
+from pretix.control.forms.filter import FilterForm
+from pretix.control.forms.widgets import Select2
 from pretix_cartshare.models import SharedCart
 
 
-class SharedCartForm(forms.ModelForm):
-    class Meta:
-        model = SharedCart
-        fields = [
-            'expires'
-        ]
+def subevent_widget(event):
+    return Select2(
+        attrs={
+            'data-model-select2': 'event',
+            'data-select2-url': reverse('control:event.subevents.select2', kwargs={
+                'event': event.slug,
+                'organizer': event.organizer.slug,
+            }),
+            'data-placeholder': pgettext_lazy('subevent', 'Date')
+        }
+    )
+
+
+with scopes_disabled():
+    class SharedCartForm(forms.ModelForm):
+        reserve_on_redemption = forms.BooleanField(
+            label=_("Reserve products on redemption only"),
+            help_text=_("If checked, the cart does not hold any quota. It then serves as a template that can be "
+                        "redeemed multiple times and quota is only used by the people who redeem it."),
+            required=False
+        )
+        field_order = ['subevent', 'expires', 'reserve_on_redemption', 'release_unopened_at', 'max_redemptions']
+
+        class Meta:
+            model = SharedCart
+            fields = [
+                'subevent',
+                'expires',
+                'release_unopened_at',
+                'max_redemptions',
+            ]
+
+        def __init__(self, *args, **kwargs):
+            self.event = kwargs.pop('event')
+            super().__init__(*args, **kwargs)
+
+            if self.event.has_subevents:
+                self.fields['subevent'].queryset = self.event.subevents.all()
+                self.fields['subevent'].required = True
+                self.fields['subevent'].widget = subevent_widget(self.event)
+                self.fields['subevent'].widget.choices = self.fields['subevent'].choices
+            else:
+                del self.fields['subevent']
+
+        def clean(self):
+            data = super().clean()
+            # The option is inverted, so a missing checkbox keeps the products reserved
+            data['reserved'] = self.instance.reserved = not data.get('reserve_on_redemption')
+            if data.get('reserved') and data.get('max_redemptions'):
+                raise ValidationError(_('A limit of redemptions can only be set if the products are not reserved.'))
+            if not data.get('reserved') and data.get('release_unopened_at'):
+                raise ValidationError(_('A reservation can only be released if the products are reserved.'))
+            return data
+
+
+@scopes_disabled()
+def get_itemvar_choices(event):
+    """
+    Returns the list of item/variation choices for all active products of an event. The list is cached
+    across requests in the event's cache, which pretix clears whenever an item or variation changes. Set
+    ``CARTSHARE_CHOICES_CACHE_TIMEOUT`` to ``0`` to disable the cache.
+    """
+    timeout = getattr(settings, 'CARTSHARE_CHOICES_CACHE_TIMEOUT', 3600)
+    cache_key = 'cartshare_itemvar_choices_{}'.format(get_language())
+    if timeout:
+        choices = event.cache.get(cache_key)
+        if choices is not None:
+            return choices
+
+    choices = []
+    for i in event.items.prefetch_related('variations').filter(active=True):
+        pname = str(i.name)
+        variations = list(i.variations.all())
+        if variations:
+            for v in variations:
+                if v.active:
+                    choices.append(('%d-%d' % (i.pk, v.pk), '%s – %s' % (pname, v.value)))
+        else:
+            choices.append((str(i.pk), pname))
+
+    if timeout:
+        event.cache.set(cache_key, choices, timeout)
+    return choices
+
+
+@scopes_disabled()
+def resolve_itemvar_choices(event, values):
+    """
+    Returns the item/variation choices of an event in the format of :py:func:`get_itemvar_choices`, but only for
+    the products referenced by ``values``. The products and their variations are read with a single query, so
+    submitted forms can be validated without building the full list of choices.
+    """
+    itemids = {int(v.split('-')[0]) for v in values if v and v.split('-')[0].isdigit()}
+    if not itemids:
+        return []
+
+    variations = {}
+    for itemid, name, varid, value, active in event.items.filter(pk__in=itemids, active=True).values_list(
+        'pk', 'name', 'variations__pk', 'variations__value', 'variations__active'
+    ).order_by('position', 'pk', 'variations__position', 'variations__pk'):
+        variations.setdefault((itemid, str(name)), []).append((varid, value, active))
+
+    choices = []
+    for (itemid, pname), rows in variations.items():
+        if rows[0][0] is None:
+            choices.append((str(itemid), pname))
+        else:
+            for varid, value, active in rows:
+                if active:
+                    choices.append(('%d-%d' % (itemid, varid), '%s – %s' % (pname, value)))
+    return choices
+
+
+class ItemVarSelect2(forms.Select):
+    """
+    A select box that is searched and filled through the typeahead view of this plugin, so it only needs to
+    render the selected product.
+    """
+    template_name = 'pretixcontrol/select2_widget.html'
 
 
 class CartPositionForm(forms.Form):
     count = forms.IntegerField(
         label=_("Count"),
-        initial=1
+        initial=1,
+        min_value=1
     )
     itemvar = forms.ChoiceField(
-        label=_("Product")
+        label=_("Product"),
+        widget=ItemVarSelect2
     )
     price = forms.DecimalField(
         required=False,
@@ -28,20 +159,21 @@ class CartPositionForm(forms.Form):
 
     )
 
-    @scopes_disabled()
-    def __init__(self, *args, event=None, **kwargs):
+    def __init__(self, *args, event=None, itemvar_choices=None, **kwargs):
         super().__init__(*args, **kwargs)
-        choices = []
-        for i in event.items.prefetch_related('variations').filter(active=True):
-            pname = i.name
-            variations = list(i.variations.all())
-            if variations:
-                for v in variations:
-                    if v.active:
-                        choices.append(('%d-%d' % (i.pk, v.pk), '%s – %s' % (pname, v.value)))
-            else:
-                choices.append((str(i.pk), pname))
-        self.fields['itemvar'].choices = choices
+        value = self.data.get(self.add_prefix('itemvar')) if self.is_bound else None
+        if itemvar_choices is None:
+            itemvar_choices = resolve_itemvar_choices(event, [value])
+        # Only the submitted product is a valid choice, the others are found through the typeahead view
+        self.fields['itemvar'].choices = [('', '')] + [c for c in itemvar_choices if c[0] == value]
+        self.fields['itemvar'].widget.attrs.update({
+            'data-model-select2': 'generic',
+            'data-select2-url': reverse('plugins:pretix_cartshare:create.itemvars', kwargs={
+                'event': event.slug,
+                'organizer': event.organizer.slug,
+            }),
+            'data-placeholder': _('Product'),
+        })
 
 
 class FormSet(BaseFormSet):
@@ -54,8 +186,17 @@ class FormSet(BaseFormSet):
         self.event = kwargs.pop('event', None)
         super().__init__(*args, **kwargs)
 
+    @cached_property
+    def itemvar_choices(self):
+        if not self.is_bound:
+            return []
+        return resolve_itemvar_choices(self.event, [
+            self.data.get('%s-%d-itemvar' % (self.prefix, i)) for i in range(self.total_form_count())
+        ])
+
     def _construct_form(self, i, **kwargs):
         kwargs['event'] = self.event
+        kwargs['itemvar_choices'] = self.itemvar_choices
         return super()._construct_form(i, **kwargs)
 
     @property
@@ -65,10 +206,196 @@ class FormSet(BaseFormSet):
             prefix=self.add_prefix('__prefix__'),
             empty_permitted=True,
             use_required_attribute=False,
-            event=self.event
+            event=self.event,
+            itemvar_choices=self.itemvar_choices
         )
         self.add_fields(form, None)
         return form
 
 
 CartPositionFormSet = formset_factory(CartPositionForm, formset=FormSet, extra=1, can_order=False, can_delete=True)
+
+
+class SharedCartImportForm(forms.Form):
+    expires = forms.DateTimeField(
+        label=_("Expiration date")
+    )
+    file = forms.FileField(
+        label=_("Import file"),
+        help_text=_('A CSV file with the columns "reference", "item", "variation", "count" and "price" or a JSON '
+                    'file with a list of objects with the keys "reference" and "lines". Lines with the same '
+                    'reference end up in the same cart. Items and variations are given by their ID, the price '
+                    'may be left empty to use the default price.')
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.event = kwargs.pop('event')
+        super().__init__(*args, **kwargs)
+
+        if self.event.has_subevents:
+            self.fields['subevent'] = forms.ModelChoiceField(
+                label=pgettext_lazy('subevent', 'Date'),
+                help_text=_('All imported carts are created for this date.'),
+                queryset=self.event.subevents.all(),
+                widget=subevent_widget(self.event)
+            )
+            self.fields['subevent'].widget.choices = self.fields['subevent'].choices
+            self.order_fields(['subevent'])
+
+    def clean_file(self):
+        f = self.cleaned_data['file']
+        try:
+            content = f.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ValidationError(_('The file needs to be UTF-8 encoded.'))
+
+        if f.name.lower().endswith('.json') or content.lstrip().startswith('['):
+            carts = self._parse_json(content)
+        else:
+            carts = self._parse_csv(content)
+        if not carts:
+            raise ValidationError(_('The file does not contain any carts.'))
+        return carts
+
+    def _parse_line(self, reference, line):
+        try:
+            item = int(line['item'])
+            variation = int(line['variation']) if line.get('variation') not in (None, '') else None
+            count = int(line.get('count') or 1)
+            price = Decimal(str(line['price'])) if line.get('price') not in (None, '') else None
+        except (KeyError, TypeError, ValueError, InvalidOperation):
+            raise ValidationError(_('The cart "{reference}" contains an invalid line.').format(reference=reference))
+        if count < 1:
+            raise ValidationError(_('The cart "{reference}" contains an invalid line.').format(reference=reference))
+        return item, variation, count, price
+
+    def _parse_csv(self, content):
+        carts = {}
+        reader = csv.DictReader(io.StringIO(content))
+        if not reader.fieldnames or 'reference' not in reader.fieldnames or 'item' not in reader.fieldnames:
+            raise ValidationError(_('The CSV file needs to contain at least the columns "reference" and "item".'))
+        for row in reader:
+            carts.setdefault(row['reference'], []).append(self._parse_line(row['reference'], row))
+        return carts
+
+    def _parse_json(self, content):
+        carts = {}
+        try:
+            data = json.loads(content)
+            for cart in data:
+                carts.setdefault(str(cart['reference']), []).extend(
+                    self._parse_line(cart['reference'], line) for line in cart['lines']
+                )
+        except (ValueError, KeyError, TypeError):
+            raise ValidationError(_('The JSON file does not have the expected structure.'))
+        return carts
+
+
+class SharedCartBulkActionForm(forms.Form):
+    action = forms.ChoiceField(
+        label=_("Action"),
+        choices=(
+            ('delete', _('Delete')),
+            ('extend', _('Change expiration date')),
+            ('release', _('Release reserved products')),
+        )
+    )
+    expires = forms.DateTimeField(
+        label=_("New expiration date"),
+        required=False
+    )
+    confirmed = forms.BooleanField(
+        widget=forms.HiddenInput,
+        required=False
+    )
+
+    def clean(self):
+        data = super().clean()
+        if data.get('action') == 'extend' and not data.get('expires'):
+            raise ValidationError(_('Please enter the new expiration date.'))
+        return data
+
+
+class SharedCartFilterForm(FilterForm):
+    orders = {
+        'datetime': 'datetime',
+        'expires': 'expires',
+        'total': 'total',
+    }
+    query = forms.CharField(
+        label=_('Cart ID'),
+        widget=forms.TextInput(attrs={
+            'placeholder': _('Cart ID'),
+            'autofocus': 'autofocus'
+        }),
+        required=False
+    )
+    total_min = forms.DecimalField(
+        label=_('Total from'),
+        widget=forms.NumberInput(attrs={'placeholder': _('Total from')}),
+        max_digits=10, decimal_places=2,
+        required=False
+    )
+    total_max = forms.DecimalField(
+        label=_('Total until'),
+        widget=forms.NumberInput(attrs={'placeholder': _('Total until')}),
+        max_digits=10, decimal_places=2,
+        required=False
+    )
+    created_from = forms.DateField(
+        label=_('Created from'),
+        required=False,
+        widget=DatePickerWidget,
+    )
+    created_until = forms.DateField(
+        label=_('Created until'),
+        required=False,
+        widget=DatePickerWidget,
+    )
+    expires_from = forms.DateField(
+        label=_('Expires from'),
+        required=False,
+        widget=DatePickerWidget,
+    )
+    expires_until = forms.DateField(
+        label=_('Expires until'),
+        required=False,
+        widget=DatePickerWidget,
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.event = kwargs.pop('event')
+        super().__init__(*args, **kwargs)
+
+    def _day_start(self, d):
+        return make_aware(datetime.combine(d, time(hour=0, minute=0, second=0, microsecond=0)), self.event.timezone)
+
+    def _day_end(self, d):
+        return make_aware(datetime.combine(d, time(hour=23, minute=59, second=59, microsecond=999999)),
+                          self.event.timezone)
+
+    def filter_qs(self, qs):
+        """
+        Filters a queryset of shared carts. The cart ID is matched by prefix, so the search can use the index on
+        ``cart_id`` instead of scanning all carts.
+        """
+        fdata = self.cleaned_data
+
+        if fdata.get('query'):
+            qs = qs.filter(cart_id__startswith=fdata['query'].strip())
+        if fdata.get('total_min') is not None:
+            qs = qs.filter(total__gte=fdata['total_min'])
+        if fdata.get('total_max') is not None:
+            qs = qs.filter(total__lte=fdata['total_max'])
+        if fdata.get('created_from'):
+            qs = qs.filter(datetime__gte=self._day_start(fdata['created_from']))
+        if fdata.get('created_until'):
+            qs = qs.filter(datetime__lte=self._day_end(fdata['created_until']))
+        if fdata.get('expires_from'):
+            qs = qs.filter(expires__gte=self._day_start(fdata['expires_from']))
+        if fdata.get('expires_until'):
+            qs = qs.filter(expires__lte=self._day_end(fdata['expires_until']))
+
+        if fdata.get('ordering'):
+            qs = qs.order_by(self.get_order_by(), '-pk')
+        return qs
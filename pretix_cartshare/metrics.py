@@ -0,0 +1,96 @@
+import logging
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.db import connection
+from django.dispatch import Signal
+from pretix.base.metrics import Counter, Histogram
+from pretix.base.models import Quota
+
+logger = logging.getLogger(__name__)
+
+pretix_cartshare_lock_held_seconds = Histogram("pretix_cartshare_lock_held_seconds",
+                                               "Time the event or quota lock was held by a shared cart operation.",
+                                               ["operation"])
+pretix_cartshare_redeem_rejected = Counter("pretix_cartshare_redeem_rejected_total",
+                                           "Requests to the shared cart URL that were rejected.",
+                                           ["reason"])
+
+cartshare_timing = Signal(
+    providing_args=["operation", "phase", "duration", "queries"]
+)
+"""
+This signal is sent out after a measured step of a shared cart operation. ``operation`` is one of ``create``,
+``redeem`` or ``cleanup`` and ``phase`` names the step, e.g. ``lock_wait``, ``lock_held``, ``quota_check``,
+``bulk_insert``, ``get``, ``post``, ``release``, ``chunk`` or ``total``. ``duration`` is the wall time in seconds
+and ``queries`` the number of database queries executed during the step.
+
+The ``sender`` keyword argument contains the event, or ``None`` for the cleanup of all events.
+"""
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def measure(operation, phase, event=None):
+    """
+    Measures the wall time and the number of database queries of a block. The result is sent through the
+    ``cartshare_timing`` signal and logged to the ``pretix_cartshare.metrics`` logger on ``DEBUG`` level. If the
+    signal has no receivers and the log level is not enabled, nothing is measured at all.
+    """
+    if not cartshare_timing.has_listeners() and not logger.isEnabledFor(logging.DEBUG):
+        yield
+        return
+
+    counter = _QueryCounter()
+    started = time.monotonic()
+    try:
+        with connection.execute_wrapper(counter):
+            yield
+    finally:
+        duration = time.monotonic() - started
+        logger.debug('operation=%s phase=%s event=%s duration=%.6f queries=%d', operation, phase,
+                     event.pk if event else '-', duration, counter.count)
+        cartshare_timing.send(sender=event, operation=operation, phase=phase, duration=duration,
+                              queries=counter.count)
+
+
+@contextmanager
+def _timed_lock(event, operation, acquire):
+    with ExitStack() as stack:
+        with measure(operation, 'lock_wait', event):
+            acquire(stack)
+        locked_since = time.monotonic()
+        try:
+            with measure(operation, 'lock_held', event):
+                yield
+        finally:
+            pretix_cartshare_lock_held_seconds.observe(time.monotonic() - locked_since, operation=operation)
+
+
+def event_lock(event, operation):
+    """
+    Acquires the lock of ``event`` and reports the time spent waiting for it and holding it.
+    """
+    return _timed_lock(event, operation, lambda stack: stack.enter_context(event.lock()))
+
+
+def quota_lock(event, quotas, operation):
+    """
+    Locks the rows of ``quotas`` with ``SELECT ... FOR UPDATE`` and reports the time spent waiting for them and
+    holding them. The rows are locked in the order of their primary keys, so operations on overlapping quotas
+    cannot deadlock. Needs to be called inside a transaction, which keeps the rows locked until it ends.
+    """
+    def acquire(stack):
+        list(Quota.objects.select_for_update().filter(pk__in=[q.pk for q in quotas]).order_by('pk').values_list(
+            'pk', flat=True
+        ))
+
+    return _timed_lock(event, operation, acquire)
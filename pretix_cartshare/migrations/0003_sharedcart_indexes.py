@@ -0,0 +1,31 @@
+# Generated by Django 3.0.14 on 2026-10-18 08:25
+
+import pretix_cartshare.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_cartshare', '0002_auto_20161008_1047'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sharedcart',
+            name='cart_id',
+            field=models.CharField(db_index=True, default=pretix_cartshare.models.generate_cart_id, max_length=255),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sharedcart',
+            unique_together={('event', 'cart_id')},
+        ),
+        migrations.AddIndex(
+            model_name='sharedcart',
+            index=models.Index(fields=['event', 'expires', 'datetime'], name='cartshare_event_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sharedcart',
+            index=models.Index(fields=['expires'], name='cartshare_expires_idx'),
+        ),
+    ]
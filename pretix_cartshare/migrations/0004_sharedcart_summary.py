@@ -0,0 +1,61 @@
+# Generated by Django 3.0.14 on 2026-10-18 09:12
+
+from collections import Counter
+
+from django.db import migrations, models
+
+
+def format_summary(positions):
+    # Frozen copy of pretix_cartshare.models.format_summary at the time of this migration
+    counts = Counter(
+        '%s – %s' % (item.name, variation.value) if variation else str(item.name)
+        for item, variation in positions
+    )
+    return ', '.join('%dx %s' % (count, name) for name, count in counts.items())
+
+
+def backfill_summary(apps, schema_editor):
+    SharedCart = apps.get_model('pretix_cartshare', 'SharedCart')
+    CartPosition = apps.get_model('pretixbase', 'CartPosition')
+
+    last_pk = 0
+    while True:
+        carts = list(SharedCart.objects.filter(pk__gt=last_pk).order_by('pk')[:500])
+        if not carts:
+            break
+        last_pk = carts[-1].pk
+
+        positions = {}
+        for cp in CartPosition.objects.filter(
+            cart_id__in=[sc.cart_id for sc in carts]
+        ).select_related('item', 'variation').order_by('pk'):
+            positions.setdefault((cp.event_id, cp.cart_id), []).append((cp.item, cp.variation))
+
+        for sc in carts:
+            cart_positions = positions.get((sc.event_id, sc.cart_id), [])
+            sc.position_count = len(cart_positions)
+            sc.summary = format_summary(cart_positions)
+        SharedCart.objects.bulk_update(carts, ['position_count', 'summary'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0038_auto_20160924_1448'),
+        ('pretix_cartshare', '0003_sharedcart_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sharedcart',
+            name='position_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sharedcart',
+            name='summary',
+            field=models.TextField(default=''),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_summary, migrations.RunPython.noop),
+    ]
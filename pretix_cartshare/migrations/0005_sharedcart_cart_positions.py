@@ -0,0 +1,42 @@
+# Generated by Django 3.0.14 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+def link_positions(apps, schema_editor):
+    SharedCart = apps.get_model('pretix_cartshare', 'SharedCart')
+    CartPosition = apps.get_model('pretixbase', 'CartPosition')
+    Through = SharedCart.cart_positions.through
+
+    last_pk = 0
+    while True:
+        carts = list(SharedCart.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'event_id', 'cart_id')[:500])
+        if not carts:
+            break
+        last_pk = carts[-1][0]
+
+        cart_pks = {(event_id, cart_id): pk for pk, event_id, cart_id in carts}
+        Through.objects.bulk_create([
+            Through(sharedcart_id=cart_pks[(event_id, cart_id)], cartposition_id=cp_pk)
+            for cp_pk, event_id, cart_id in CartPosition.objects.filter(
+                cart_id__in=[c[2] for c in carts]
+            ).values_list('pk', 'event_id', 'cart_id')
+            if (event_id, cart_id) in cart_pks
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0038_auto_20160924_1448'),
+        ('pretix_cartshare', '0004_sharedcart_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sharedcart',
+            name='cart_positions',
+            field=models.ManyToManyField(related_name='_sharedcart_cart_positions_+', to='pretixbase.CartPosition'),
+        ),
+        migrations.RunPython(link_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0038_auto_20160924_1448'),
+        ('pretix_cartshare', '0005_sharedcart_cart_positions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sharedcart',
+            name='max_redemptions',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sharedcart',
+            name='redemptions',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sharedcart',
+            name='reserved',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.CreateModel(
+            name='SharedCartLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('count', models.PositiveIntegerField(default=1)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('cart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='pretix_cartshare.SharedCart')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pretixbase.Item')),
+                ('variation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='pretixbase.ItemVariation')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_cartshare', '0006_sharedcartline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sharedcart',
+            name='opened',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sharedcart',
+            name='release_unopened_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='sharedcart',
+            index=models.Index(fields=['release_unopened_at'], name='cartshare_release_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.14 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_cartshare', '0007_sharedcart_opened'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sharedcart',
+            index=models.Index(fields=['event', 'total'], name='cartshare_event_total_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sharedcart',
+            index=models.Index(fields=['event', 'datetime'], name='cartshare_event_datetime_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.14 on 2026-10-18 16:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0038_auto_20160924_1448'),
+        ('pretix_cartshare', '0008_sharedcart_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedCartLogEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('cart_id', models.CharField(max_length=255)),
+                ('action', models.CharField(max_length=20)),
+                ('datetime', models.DateTimeField(auto_now_add=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pretixbase.Event')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SharedCartCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('action', models.CharField(max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pretixbase.Event')),
+            ],
+            options={
+                'unique_together': {('event', 'action')},
+            },
+        ),
+    ]
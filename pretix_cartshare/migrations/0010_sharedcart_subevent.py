@@ -0,0 +1,21 @@
+# Generated by Django 3.0.14 on 2026-10-18 17:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0052_team_teaminvite_squashed_0070_auto_20170719_0910'),
+        ('pretix_cartshare', '0009_sharedcartlogentry_sharedcartcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sharedcart',
+            name='subevent',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    to='pretixbase.SubEvent'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_cartshare', '0010_sharedcart_subevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sharedcart',
+            name='reserved',
+            field=models.BooleanField(default=True, help_text='If active, the products are reserved as cart positions when the cart is created, and the cart can be redeemed once. Otherwise, the cart does not hold any quota and serves as a template that can be redeemed multiple times.', verbose_name='Reserve products now'),
+        ),
+    ]
@@ -1,13 +1,41 @@
+import re
+from collections import Counter
+
 from django.db import models
+from django.db.models import Prefetch, prefetch_related_objects
 from django.utils.crypto import get_random_string
-from django.utils.translation import ugettext_lazy as _
-from pretix.base.models import CartPosition, Event
+from django.utils.translation import pgettext_lazy, ugettext_lazy as _
+from pretix.base.models import (
+    CartPosition, Event, Item, ItemVariation, SubEvent,
+)
+
+CART_ID_RE = re.compile(r'[a-zA-Z0-9]{12,32}')
 
 
 def generate_cart_id():
     return get_random_string(32)
 
 
+def is_valid_cart_id(cart_id):
+    """
+    Returns whether ``cart_id`` has the format of the IDs of :py:func:`generate_cart_id`. Carts created by earlier
+    versions of this plugin have IDs of 12 characters instead of 32.
+    """
+    return bool(CART_ID_RE.fullmatch(cart_id))
+
+
+def format_summary(positions):
+    """
+    Builds the compact product summary stored on a shared cart from an iterable of ``(item, variation)`` tuples,
+    one per cart position.
+    """
+    counts = Counter(
+        '%s – %s' % (item.name, variation.value) if variation else str(item.name)
+        for item, variation in positions
+    )
+    return ', '.join('%dx %s' % (count, name) for name, count in counts.items())
+
+
 class SharedCart(models.Model):
     event = models.ForeignKey(
         Event, on_delete=models.CASCADE,
@@ -18,6 +46,11 @@ class SharedCart(models.Model):
         verbose_name=_("Cart ID"),
         db_index=True,
     )
+    subevent = models.ForeignKey(
+        SubEvent, on_delete=models.CASCADE,
+        verbose_name=pgettext_lazy("subevent", "Date"),
+        null=True, blank=True
+    )
     datetime = models.DateTimeField(
         verbose_name=_("Date"),
         auto_now_add=True
@@ -29,7 +62,165 @@ class SharedCart(models.Model):
         verbose_name=_("Total"),
         decimal_places=2, max_digits=10
     )
+    position_count = models.PositiveIntegerField(
+        verbose_name=_("Number of positions"),
+        default=0
+    )
+    summary = models.TextField(
+        verbose_name=_("Products"),
+        blank=True
+    )
+    cart_positions = models.ManyToManyField(
+        CartPosition,
+        related_name='+',
+        verbose_name=_("Cart positions")
+    )
+    reserved = models.BooleanField(
+        verbose_name=_("Reserve products now"),
+        help_text=_("If active, the products are reserved as cart positions when the cart is created, and the cart "
+                    "can be redeemed once. Otherwise, the cart does not hold any quota and serves as a template "
+                    "that can be redeemed multiple times."),
+        default=True
+    )
+    max_redemptions = models.PositiveIntegerField(
+        verbose_name=_("Maximum number of redemptions"),
+        help_text=_("Only applies if the products are not reserved. Leave empty for no limit."),
+        null=True, blank=True
+    )
+    redemptions = models.PositiveIntegerField(
+        verbose_name=_("Redemptions"),
+        default=0
+    )
+    opened = models.DateTimeField(
+        verbose_name=_("First opened"),
+        null=True, blank=True
+    )
+    release_unopened_at = models.DateTimeField(
+        verbose_name=_("Release reservation if not opened by"),
+        help_text=_("If nobody opened the cart link until then, the products are no longer reserved. The cart can "
+                    "still be redeemed once if the products are available at that time."),
+        null=True, blank=True
+    )
+
+    class Meta:
+        unique_together = (('event', 'cart_id'),)
+        indexes = [
+            models.Index(fields=['event', 'expires', 'datetime'], name='cartshare_event_expires_idx'),
+            models.Index(fields=['expires'], name='cartshare_expires_idx'),
+            models.Index(fields=['release_unopened_at'], name='cartshare_release_idx'),
+            models.Index(fields=['event', 'total'], name='cartshare_event_total_idx'),
+            models.Index(fields=['event', 'datetime'], name='cartshare_event_datetime_idx'),
+        ]
+
+    def clear_cache(self):
+        """
+        Removes the cached redeem page preview of this cart in all languages of the event.
+        """
+        self.event.cache.delete_many([
+            'cartshare_redeem_{}_{}'.format(self.cart_id, locale) for locale in self.event.settings.locales
+        ])
 
     @property
     def positions(self):
-        return CartPosition.objects.filter(cart_id=self.cart_id, event=self.event)
+        return self.cart_positions.all()
+
+    def build_positions(self, cart_id=None, expires=None):
+        """
+        Creates unsaved cart positions from the lines of a cart that does not reserve its products. The lines are
+        fetched with their products in one query, unless they have been prefetched already.
+        """
+        prefetch_related_objects([self], Prefetch(
+            'lines', queryset=SharedCartLine.objects.select_related('item', 'item__tax_rule', 'variation')
+        ))
+        return [
+            CartPosition(
+                item=line.item, variation=line.variation, event=self.event, subevent=self.subevent, price=line.price,
+                cart_id=cart_id or self.cart_id, expires=expires or self.expires
+            )
+            for line in self.lines.all() for i in range(line.count)
+        ]
+
+
+class SharedCartLine(models.Model):
+    """
+    A product of a shared cart that does not reserve its products. Cart positions are only created from the
+    lines when the cart is redeemed.
+    """
+    cart = models.ForeignKey(
+        SharedCart, on_delete=models.CASCADE,
+        related_name='lines'
+    )
+    item = models.ForeignKey(
+        Item, on_delete=models.CASCADE,
+        verbose_name=_("Product")
+    )
+    variation = models.ForeignKey(
+        ItemVariation, on_delete=models.CASCADE,
+        verbose_name=_("Variation"),
+        null=True, blank=True
+    )
+    count = models.PositiveIntegerField(
+        verbose_name=_("Count"),
+        default=1
+    )
+    price = models.DecimalField(
+        verbose_name=_("Price per item"),
+        decimal_places=2, max_digits=10
+    )
+
+
+class SharedCartLogEntry(models.Model):
+    """
+    An append-only record of something that happened to a shared cart. Entries refer to the cart by its ID
+    only, so they outlive the cart. They are added up into :py:class:`SharedCartCounter` periodically.
+    """
+    ACTION_CREATED = 'created'
+    ACTION_VIEWED = 'viewed'
+    ACTION_REDEEMED = 'redeemed'
+    ACTION_EXPIRED = 'expired'
+    ACTION_DELETED = 'deleted'
+    ACTIONS = (
+        (ACTION_CREATED, _('Created')),
+        (ACTION_VIEWED, _('Opened')),
+        (ACTION_REDEEMED, _('Redeemed')),
+        (ACTION_EXPIRED, _('Expired')),
+        (ACTION_DELETED, _('Deleted')),
+    )
+
+    event = models.ForeignKey(
+        Event, on_delete=models.CASCADE,
+        verbose_name=_("Event")
+    )
+    cart_id = models.CharField(
+        max_length=255,
+        verbose_name=_("Cart ID")
+    )
+    action = models.CharField(
+        max_length=20, choices=ACTIONS,
+        verbose_name=_("Action")
+    )
+    datetime = models.DateTimeField(
+        verbose_name=_("Date"),
+        auto_now_add=True
+    )
+
+
+class SharedCartCounter(models.Model):
+    """
+    The number of log entries of one action for an event, as of the last aggregation run.
+    """
+    event = models.ForeignKey(
+        Event, on_delete=models.CASCADE,
+        verbose_name=_("Event")
+    )
+    action = models.CharField(
+        max_length=20, choices=SharedCartLogEntry.ACTIONS,
+        verbose_name=_("Action")
+    )
+    count = models.PositiveIntegerField(
+        verbose_name=_("Count"),
+        default=0
+    )
+
+    class Meta:
+        unique_together = (('event', 'action'),)
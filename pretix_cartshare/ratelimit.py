@@ -0,0 +1,67 @@
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Without a refill, an exhausted bucket is forgotten after this many seconds
+NO_REFILL_TIMEOUT = 3600
+
+
+def _limits():
+    return (getattr(settings, 'CARTSHARE_REDEEM_RATE_LIMIT_BURST', 20),
+            getattr(settings, 'CARTSHARE_REDEEM_RATE_LIMIT_REFILL', 0.2))
+
+
+def _key(ip):
+    return 'cartshare_redeem_bucket_{}'.format(ip)
+
+
+def _bucket(ip, burst, refill):
+    """
+    Returns the current number of tokens in the bucket of ``ip`` and the time of its last update.
+    """
+    state = cache.get(_key(ip))
+    if state is None:
+        return burst, None
+    tokens, updated = state
+    if refill > 0:
+        tokens = min(burst, tokens + (time.time() - updated) * refill)
+    return tokens, updated
+
+
+def retry_after(ip):
+    """
+    Returns the number of seconds the client with the IP address ``ip`` has to wait before it may look up another
+    shared cart, or 0 if it is not limited.
+
+    Every client has a bucket of ``CARTSHARE_REDEEM_RATE_LIMIT_BURST`` tokens, which is refilled with
+    ``CARTSHARE_REDEEM_RATE_LIMIT_REFILL`` tokens per second. Only lookups of unknown or expired carts take a token
+    out. Once the bucket is empty, every request of the client is rejected before the lookup, including requests
+    for valid carts, so that the limit also bounds the database load. Customers sharing an IP address, e.g. behind
+    a NAT, therefore share a bucket as well. With a refill of 0 or less, the bucket is not refilled but forgotten
+    :py:data:`NO_REFILL_TIMEOUT` seconds after the last failed lookup. Setting the burst to ``None`` disables the
+    limit.
+    """
+    burst, refill = _limits()
+    if burst is None:
+        return 0
+    tokens, updated = _bucket(ip, burst, refill)
+    if tokens >= 1:
+        return 0
+    if refill > 0:
+        return math.ceil((1 - tokens) / refill)
+    return max(math.ceil(updated + NO_REFILL_TIMEOUT - time.time()), 1)
+
+
+def record_failure(ip):
+    """
+    Takes a token out of the bucket of the client with the IP address ``ip``. The bucket is read and written
+    without a lock, so concurrent requests of the same client may occasionally be counted once only.
+    """
+    burst, refill = _limits()
+    if burst is None:
+        return
+    tokens, updated = _bucket(ip, burst, refill)
+    cache.set(_key(ip), (max(tokens - 1, 0), time.time()),
+              math.ceil(burst / refill) if refill > 0 else NO_REFILL_TIMEOUT)
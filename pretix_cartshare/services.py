@@ -0,0 +1,481 @@
+from collections import Counter
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Prefetch, Q, prefetch_related_objects
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+from django.utils.translation import ugettext_lazy as _
+from pretix.base.i18n import language
+from pretix.base.models import (
+    CartPosition, Event, ItemVariation, Quota, SubEvent,
+)
+from pretix.base.services.cart import CartError
+from pretix.base.services.locking import LockTimeoutException
+from pretix.base.services.quotas import QuotaAvailability
+from pretix.base.services.tasks import ProfiledEventTask
+from pretix.celery_app import app
+
+from .forms import SharedCartFilterForm
+from .metrics import event_lock, measure, quota_lock
+from .models import (
+    SharedCart, SharedCartLine, SharedCartLogEntry, format_summary,
+)
+
+# The cleanup task stores the earliest expiry or release date of all shared carts here, see ``clean_cart_positions``
+NEXT_EXPIRY_CACHE_KEY = 'pretix_cartshare_next_expiry'
+# Upper bound for how long a missed cache invalidation can delay the cleanup
+NEXT_EXPIRY_CACHE_TIMEOUT = 3600
+
+QUOTA_SNAPSHOT_CACHE_KEY = 'cartshare_quota_{}'
+
+error_messages = {
+    'quota': _('The quota {name} does not have enough capacity left to perform the operation.'),
+    'product': _('One of the selected products is no longer available.'),
+    'redeemed': _('This cart has already been redeemed.'),
+    'positions': _('The products of this cart are no longer reserved.'),
+    'subevent': _('Please select a date.'),
+}
+
+
+def log_carts(action: str, carts):
+    """
+    Appends one log entry with ``action`` for every ``(event_id, cart_id)`` tuple in ``carts`` with a single
+    INSERT statement.
+    """
+    SharedCartLogEntry.objects.bulk_create([
+        SharedCartLogEntry(event_id=event_id, cart_id=cart_id, action=action) for event_id, cart_id in carts
+    ])
+
+
+def parse_itemvar(itemvar):
+    """
+    Splits an ``itemvar`` value as used by ``CartPositionForm`` (``"<item>"`` or ``"<item>-<variation>"``)
+    into a tuple of integer IDs.
+    """
+    if '-' in itemvar:
+        itemid, varid = itemvar.split('-')
+        return int(itemid), int(varid)
+    return int(itemvar), None
+
+
+def resolve_lines(event: Event, lines, subevent: SubEvent = None):
+    """
+    Resolves the items, variations and quotas of a list of ``(item_id, variation_id, count, price)`` tuples with
+    a fixed number of queries, independent of the number of lines. Only the quotas of ``subevent`` are loaded.
+    Returns a list of ``(item, variation, count, price)`` tuples or raises ``CartError`` if a product does not
+    exist.
+    """
+    lines = list(lines)
+    items = {
+        i.pk: i for i in event.items.filter(
+            pk__in={line[0] for line in lines}
+        ).prefetch_related(
+            Prefetch('quotas', queryset=Quota.objects.filter(subevent=subevent).select_related('event'))
+        )
+    }
+    variations = {
+        v.pk: v for v in ItemVariation.objects.filter(
+            pk__in={line[1] for line in lines if line[1]}, item__event=event
+        )
+    }
+
+    resolved = []
+    for itemid, varid, count, price in lines:
+        item = items.get(itemid)
+        variation = variations.get(varid) if varid else None
+        if not item or (varid and (not variation or variation.item_id != item.pk)):
+            raise CartError(error_messages['product'])
+        resolved.append((item, variation, count, price))
+    return resolved
+
+
+def _fill_pks(event, carts):
+    """
+    Not all database backends return primary keys from ``bulk_create``, so missing keys of freshly created
+    carts are fetched with one query.
+    """
+    if any(sc.pk is None for sc in carts):
+        pks = dict(SharedCart.objects.filter(event=event, cart_id__in=[sc.cart_id for sc in carts]).values_list(
+            'cart_id', 'pk'
+        ))
+        for sc in carts:
+            sc.pk = pks[sc.cart_id]
+
+
+def _link_positions(event, carts, positions):
+    """
+    Writes the links between freshly created carts and their positions.
+    """
+    cart_pks = {sc.cart_id: sc.pk for sc in carts}
+
+    if any(p.pk is None for p in positions):
+        links = CartPosition.objects.filter(event=event, cart_id__in=cart_pks.keys()).values_list('cart_id', 'pk')
+    else:
+        links = [(p.cart_id, p.pk) for p in positions]
+
+    SharedCart.cart_positions.through.objects.bulk_create([
+        SharedCart.cart_positions.through(sharedcart_id=cart_pks[cart_id], cartposition_id=cp_pk)
+        for cart_id, cp_pk in links
+    ])
+
+
+def _lock(event: Event, quotas, operation: str):
+    """
+    Returns the lock to hold while checking and consuming ``quotas``. By default, this is the event lock that the
+    cart and checkout code of pretix uses as well, so shared cart operations and customer checkouts never consume
+    the same quota at the same time.
+
+    With ``CARTSHARE_LOCKING`` set to ``'quota'``, only the rows of the affected quotas are locked, so customers
+    buying products of other quotas are not held up. Shared cart operations on the same quotas still wait for
+    each other, but pretix itself does not lock quota rows. A customer buying the last tickets of a quota in the
+    same moment can therefore make it end up oversold. Only use this if that risk is acceptable.
+    """
+    if getattr(settings, 'CARTSHARE_LOCKING', 'event') == 'quota':
+        return quota_lock(event, quotas, operation)
+    return event_lock(event, operation)
+
+
+def _check_quotas(quotas):
+    """
+    Checks a ``Counter`` of quota demand against the current availability. Needs to be called with the lock
+    returned by :py:func:`_lock` held.
+    """
+    qa = QuotaAvailability()
+    qa.queue(*quotas.keys())
+    qa.compute()
+    for quota, diff in quotas.items():
+        if not _fits(qa.results[quota], diff):
+            raise CartError(error_messages['quota'].format(name=quota.name))
+
+
+def quota_snapshot(event: Event, quotas):
+    """
+    Returns the availability of a list of quotas as a dictionary mapping quotas to ``(state, available_number)``
+    tuples. The availability is computed without any lock and cached per quota for
+    ``CARTSHARE_AVAILABILITY_CACHE_TIMEOUT`` seconds. It is not invalidated when carts are created, so it may
+    be slightly outdated and must only be used for estimates.
+    """
+    timeout = getattr(settings, 'CARTSHARE_AVAILABILITY_CACHE_TIMEOUT', 10)
+    keys = {QUOTA_SNAPSHOT_CACHE_KEY.format(quota.pk): quota for quota in quotas}
+    cached = event.cache.get_many(list(keys)) if timeout and keys else {}
+    snapshot = {keys[key]: result for key, result in cached.items()}
+
+    missing = [quota for key, quota in keys.items() if key not in cached]
+    if missing:
+        qa = QuotaAvailability()
+        qa.queue(*missing)
+        qa.compute()
+        snapshot.update(qa.results)
+        if timeout:
+            event.cache.set_many({QUOTA_SNAPSHOT_CACHE_KEY.format(quota.pk): qa.results[quota] for quota in missing},
+                                 timeout)
+    return snapshot
+
+
+def _quota_demand(lines):
+    quotas = Counter()
+    for item, variation, count, price in lines:
+        for quota in item.quotas.all():
+            quotas[quota] += count
+    return quotas
+
+
+def _fits(result, demand):
+    return result[0] == Quota.AVAILABILITY_OK and (result[1] is None or result[1] >= demand)
+
+
+def estimate_availability(event: Event, lines):
+    """
+    Estimates whether the quotas of an event can hold a list of lines as returned by :py:func:`resolve_lines`,
+    based on :py:func:`quota_snapshot`. Returns a list of ``(quota, requested, available, sufficient)`` tuples,
+    with ``available`` being ``None`` for unlimited quotas.
+    """
+    quotas = _quota_demand(lines)
+    snapshot = quota_snapshot(event, quotas.keys())
+    return [
+        (quota, requested, snapshot[quota][1] if snapshot[quota][0] == Quota.AVAILABILITY_OK else 0,
+         _fits(snapshot[quota], requested))
+        for quota, requested in quotas.items()
+    ]
+
+
+def _precheck_quotas(event, quotas):
+    """
+    Rejects requests that cannot succeed before the lock is taken. If the cached snapshot looks
+    insufficient, the availability is computed again, still without the lock, to rule out an outdated snapshot.
+    """
+    snapshot = quota_snapshot(event, quotas.keys())
+    if not all(_fits(snapshot[quota], diff) for quota, diff in quotas.items()):
+        _check_quotas(quotas)
+
+
+def create_shared_carts(event: Event, carts, expires=None):
+    """
+    Creates any number of shared carts in one transaction. ``carts`` is a list of ``(SharedCart, lines)`` tuples
+    with lines as returned by :py:func:`resolve_lines` for the date of the cart. The quota demand of all carts is added up, compared to
+    :py:func:`quota_snapshot` to turn down requests that are bound to fail without taking a lock, and
+    checked once under the lock of the affected quotas, see :py:func:`_lock`. Then all carts and cart positions
+    are written with ``bulk_create``. Carts that do not reserve their products only store their lines and do not
+    need any quota. If ``expires`` is not given, the expiry date already set on every cart is kept.
+    """
+    positions = []
+    cart_lines = []
+    quotas = Counter()
+
+    for sc, lines in carts:
+        if expires:
+            sc.expires = expires
+        if event.has_subevents and not sc.subevent:
+            raise CartError(error_messages['subevent'])
+        cart_positions = []
+        for item, variation, count, price in lines:
+            if not price:
+                price = (variation.default_price if variation and variation.default_price is not None
+                         else item.default_price)
+
+            if not sc.reserved:
+                cart_lines.append((sc, SharedCartLine(item=item, variation=variation, count=count, price=price)))
+            else:
+                for quota in item.quotas.all():
+                    quotas[quota] += count
+
+            for i in range(count):
+                cart_positions.append(CartPosition(
+                    item=item, variation=variation, event=event, subevent=sc.subevent, cart_id=sc.cart_id,
+                    expires=sc.expires, price=price
+                ))
+
+        sc.event = event
+        sc.total = sum([p.price for p in cart_positions])
+        sc.position_count = len(cart_positions)
+        sc.summary = format_summary((p.item, p.variation) for p in cart_positions)
+        if sc.reserved:
+            positions += cart_positions
+
+    with measure('create', 'quota_precheck', event):
+        _precheck_quotas(event, quotas)
+
+    with transaction.atomic():
+        with _lock(event, quotas, 'create'):
+            with measure('create', 'quota_check', event):
+                _check_quotas(quotas)
+
+            with measure('create', 'bulk_insert', event):
+                SharedCart.objects.bulk_create([sc for sc, lines in carts])
+                CartPosition.objects.bulk_create(positions)
+                _fill_pks(event, [sc for sc, lines in carts])
+                _link_positions(event, [sc for sc, lines in carts], positions)
+                for sc, line in cart_lines:
+                    line.cart = sc
+                SharedCartLine.objects.bulk_create([line for sc, line in cart_lines])
+            event.cache.delete_many(['cartshare_redeem_missing_{}'.format(sc.cart_id) for sc, lines in carts])
+        log_carts(SharedCartLogEntry.ACTION_CREATED, [(event.pk, sc.cart_id) for sc, lines in carts])
+    cache.delete(NEXT_EXPIRY_CACHE_KEY)
+
+
+def claim_shared_cart(event: Event, sc: SharedCart, cart_id: str, expires):
+    """
+    Moves the reserved positions of a shared cart to the cart ``cart_id`` and deletes the shared cart. Deleting
+    the row claims the cart, so only one of several concurrent requests succeeds. Raises ``CartError`` if the cart
+    has been redeemed, has expired or no longer reserves its products in the meantime.
+    """
+    now_dt = now()
+    # The links to the positions go away together with the cart, so they need to be read before claiming it
+    position_ids = list(sc.positions.values_list('pk', flat=True))
+    with transaction.atomic():
+        # Drop the links first, so concurrent requests always lock the link table before the cart table
+        SharedCart.cart_positions.through.objects.filter(sharedcart_id=sc.pk).delete()
+        claimed = SharedCart.objects.filter(
+            pk=sc.pk, reserved=True, expires__gte=now_dt
+        ).delete()[1].get(SharedCart._meta.label)
+        if not claimed:
+            raise CartError(error_messages['redeemed'])
+        if not CartPosition.objects.filter(pk__in=position_ids).update(expires=expires, cart_id=cart_id):
+            raise CartError(error_messages['positions'])
+        log_carts(SharedCartLogEntry.ACTION_REDEEMED, [(event.pk, sc.cart_id)])
+    sc.clear_cache()
+
+
+def redeem_shared_cart(event: Event, sc: SharedCart, cart_id: str, expires):
+    """
+    Creates fresh cart positions from a shared cart that does not reserve its products and adds them to the cart
+    ``cart_id``. The redemption is counted with a conditional update, so the limit of redemptions holds even
+    for concurrent requests. Raises ``CartError`` if the cart is used up or the quota is not sufficient.
+    """
+    now_dt = now()
+    prefetch_related_objects([sc], Prefetch(
+        'lines', queryset=SharedCartLine.objects.select_related('item', 'variation').prefetch_related(
+            Prefetch('item__quotas', queryset=Quota.objects.filter(subevent_id=sc.subevent_id).select_related('event'))
+        )
+    ))
+    positions = sc.build_positions(cart_id=cart_id, expires=expires)
+    quotas = Counter()
+    for p in positions:
+        if not p.item.active or (p.variation and not p.variation.active):
+            raise CartError(error_messages['product'])
+        for quota in p.item.quotas.all():
+            quotas[quota] += 1
+
+    with measure('redeem', 'quota_precheck', event):
+        _precheck_quotas(event, quotas)
+
+    with transaction.atomic():
+        with _lock(event, quotas, 'redeem'):
+            claimed = SharedCart.objects.filter(
+                Q(max_redemptions__isnull=True) | Q(redemptions__lt=F('max_redemptions')),
+                pk=sc.pk, expires__gte=now_dt,
+            ).update(redemptions=F('redemptions') + 1)
+            if not claimed:
+                raise CartError(error_messages['redeemed'])
+            with measure('redeem', 'quota_check', event):
+                _check_quotas(quotas)
+            with measure('redeem', 'bulk_insert', event):
+                CartPosition.objects.bulk_create(positions)
+        log_carts(SharedCartLogEntry.ACTION_REDEEMED, [(event.pk, sc.cart_id)])
+        sc.refresh_from_db(fields=['redemptions'])
+
+    if sc.max_redemptions is not None and sc.redemptions >= sc.max_redemptions:
+        sc.clear_cache()
+
+
+def _linked_positions(carts):
+    return CartPosition.objects.filter(
+        pk__in=SharedCart.cart_positions.through.objects.filter(sharedcart_id__in=carts.values('pk')).values(
+            'cartposition_id'
+        )
+    )
+
+
+def _clear_redeem_caches(event: Event, cart_ids):
+    event.cache.delete_many([
+        'cartshare_redeem_{}_{}'.format(cart_id, locale)
+        for cart_id in cart_ids for locale in event.settings.locales
+    ])
+
+
+def delete_shared_carts(event: Event, carts) -> int:
+    """
+    Deletes a queryset of shared carts together with their cart positions with set-based DELETE statements and
+    returns the number of deleted carts.
+    """
+    with transaction.atomic():
+        cart_ids = list(carts.values_list('cart_id', flat=True))
+        _clear_redeem_caches(event, cart_ids)
+        _linked_positions(carts).delete()
+        count = SharedCart.objects.filter(pk__in=carts.values('pk')).delete()[1].get(SharedCart._meta.label, 0)
+        log_carts(SharedCartLogEntry.ACTION_DELETED, [(event.pk, cart_id) for cart_id in cart_ids])
+    return count
+
+
+def extend_shared_carts(event: Event, carts, expires) -> int:
+    """
+    Sets a new expiry date on a queryset of shared carts and their cart positions with one UPDATE statement per
+    table and returns the number of updated carts.
+    """
+    with transaction.atomic():
+        _clear_redeem_caches(event, carts.values_list('cart_id', flat=True))
+        _linked_positions(carts).update(expires=expires)
+        count = SharedCart.objects.filter(pk__in=carts.values('pk')).update(expires=expires)
+    cache.delete(NEXT_EXPIRY_CACHE_KEY)
+    return count
+
+
+def release_shared_carts(carts) -> int:
+    """
+    Turns a queryset of shared carts that reserve their products into carts that can be redeemed once and
+    reserve their products only on redemption. The positions are aggregated into lines with one query and
+    then deleted, which gives their quota back. Returns the number of released carts.
+    """
+    carts = SharedCart.objects.filter(pk__in=carts.filter(reserved=True).values('pk'))
+    with transaction.atomic():
+        SharedCartLine.objects.bulk_create([
+            SharedCartLine(cart_id=row['sharedcart_id'], item_id=row['cartposition__item_id'],
+                           variation_id=row['cartposition__variation_id'], price=row['cartposition__price'],
+                           count=row['count'])
+            for row in SharedCart.cart_positions.through.objects.filter(
+                sharedcart_id__in=carts.values('pk')
+            ).values(
+                'sharedcart_id', 'cartposition__item_id', 'cartposition__variation_id', 'cartposition__price'
+            ).annotate(count=Count('pk')).order_by()
+        ])
+        _linked_positions(carts).delete()
+        return SharedCart.objects.filter(pk__in=carts.values('pk')).update(reserved=False, max_redemptions=1)
+
+
+def bulk_action(event: Event, carts, action: str, expires=None) -> int:
+    """
+    Runs one of the bulk actions of the list view on a queryset of shared carts and returns the number of
+    affected carts.
+    """
+    if action == 'delete':
+        return delete_shared_carts(event, carts)
+    elif action == 'extend':
+        return extend_shared_carts(event, carts, expires)
+    elif action == 'release':
+        return release_shared_carts(carts)
+    raise ValueError('Unknown action {}'.format(action))
+
+
+@app.task(base=ProfiledEventTask, throws=(CartError,))
+def run_bulk_action(event: Event, action: str, cart_ids: list = None, expires: str = None,
+                    filters: dict = None) -> int:
+    """
+    Runs a bulk action in the background.
+
+    :param event: The event ID in question
+    :param action: ``delete``, ``extend`` or ``release``
+    :param cart_ids: A list of shared cart IDs or ``None`` for all active carts of the event
+    :param expires: The new expiry date in ISO format, only for ``extend``
+    :param filters: The data of the list view's filter form to restrict all active carts to, if ``cart_ids`` is
+                    ``None``
+    :return: The number of affected carts
+    """
+    carts = SharedCart.objects.filter(event=event, expires__gte=now())
+    if cart_ids is not None:
+        carts = carts.filter(pk__in=cart_ids)
+    elif filters:
+        filter_form = SharedCartFilterForm(data=filters, event=event)
+        if not filter_form.is_valid():
+            # Never fall back to all carts, the filter was already validated by the view
+            return 0
+        carts = filter_form.filter_qs(carts)
+    return bulk_action(event, carts, action, parse_datetime(expires) if expires else None)
+
+
+@app.task(base=ProfiledEventTask, bind=True, max_retries=5, default_retry_delay=1, throws=(CartError,))
+def create_shared_cart(self, event: Event, cart_id: str, expires: str, lines: list, locale='en',
+                       release_unopened_at: str = None, subevent: int = None) -> str:
+    """
+    Creates a shared cart in the background.
+
+    :param event: The event ID in question
+    :param cart_id: The ID of the new shared cart
+    :param expires: The expiry date in ISO format
+    :param lines: A list of ``[item_id, variation_id, count, price]`` lists, with the price as a string or ``None``
+    :param release_unopened_at: The date in ISO format at which the reservation is released if nobody opened the
+                                cart until then, or ``None``
+    :param subevent: The ID of the date of an event series or ``None``
+    :raises CartError: On any error that occurred
+    """
+    with language(locale):
+        if subevent:
+            # The date may have been deleted since the task was queued
+            subevent = event.subevents.filter(pk=subevent).first()
+            if not subevent:
+                raise CartError(error_messages['subevent'])
+        lines = resolve_lines(event, [
+            (itemid, varid, count, Decimal(price) if price is not None else None)
+            for itemid, varid, count, price in lines
+        ], subevent)
+        try:
+            sc = SharedCart(
+                cart_id=cart_id, subevent=subevent,
+                release_unopened_at=parse_datetime(release_unopened_at) if release_unopened_at else None
+            )
+            create_shared_carts(event, [(sc, lines)], parse_datetime(expires))
+        except LockTimeoutException:
+            self.retry()
+    return cart_id
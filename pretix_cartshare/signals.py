@@ -1,11 +1,27 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q
 from django.dispatch import receiver
 from django.urls import resolve, reverse
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from django_scopes import scopes_disabled
+from pretix.base.models import CartPosition
+from pretix.base.settings import GlobalSettingsObject
 from pretix.base.signals import periodic_task
 from pretix.control.signals import nav_event
-from pretix_cartshare.models import SharedCart
+from pretix_cartshare.metrics import measure
+from pretix_cartshare.models import (
+    SharedCart, SharedCartCounter, SharedCartLogEntry,
+)
+from pretix_cartshare.services import (
+    NEXT_EXPIRY_CACHE_KEY, NEXT_EXPIRY_CACHE_TIMEOUT, log_carts,
+    release_shared_carts,
+)
 
 
 @receiver(nav_event, dispatch_uid='cartshare_nav')
@@ -24,9 +40,132 @@ def navbar_info(sender, request, **kwargs):
     }]
 
 
+logger = logging.getLogger(__name__)
+
+CLEANUP_CHUNK_SIZE = 500
+CLEANUP_MAX_CHUNKS = 20
+CLEANUP_TIME_LIMIT = 30
+
+
+@receiver(signal=periodic_task)
+@scopes_disabled()
+def clean_cart_positions(sender, chunk_size=CLEANUP_CHUNK_SIZE, max_chunks=CLEANUP_MAX_CHUNKS,
+                         time_limit=CLEANUP_TIME_LIMIT, **kwargs):
+    """
+    Deletes expired shared carts together with their cart positions. Carts are processed in chunks of
+    ``chunk_size`` with one DELETE statement per table and chunk. After ``max_chunks`` chunks or ``time_limit``
+    seconds, we stop and leave the remaining carts for the next run. Returns the number of deleted carts and
+    positions.
+
+    Before that, up to ``chunk_size`` carts that have not been opened by their ``release_unopened_at`` date give
+    their reserved products back to the quotas.
+
+    Once all expired carts are gone, the earliest expiry or release date of the remaining carts is stored in the
+    cache and the following runs return without touching the database until that date has passed.
+    """
+    cutoff = now()
+    next_expiry = cache.get(NEXT_EXPIRY_CACHE_KEY)
+    if next_expiry is not None and cutoff.timestamp() < next_expiry:
+        return 0, 0
+
+    started = time.monotonic()
+    deleted_carts = deleted_positions = 0
+    done = False
+
+    with measure('cleanup', 'total'):
+        unopened = list(
+            SharedCart.objects.filter(
+                reserved=True, opened__isnull=True, release_unopened_at__lt=cutoff, expires__gte=cutoff
+            ).order_by('release_unopened_at', 'pk').values_list('pk', flat=True)[:chunk_size]
+        )
+        if unopened:
+            with measure('cleanup', 'release'):
+                released = release_shared_carts(SharedCart.objects.filter(pk__in=unopened))
+            logger.info('Released the reservations of %d unopened shared carts.', released)
+
+        for i in range(max_chunks):
+            if time.monotonic() - started >= time_limit:
+                break
+            chunk = list(
+                SharedCart.objects.filter(expires__lt=cutoff).order_by('expires', 'pk').values_list(
+                    'pk', 'event_id', 'cart_id'
+                )[:chunk_size]
+            )
+            if not chunk:
+                done = True
+                break
+
+            with measure('cleanup', 'chunk'), transaction.atomic():
+                pks = [pk for pk, event_id, cart_id in chunk]
+                deleted_positions += CartPosition.objects.filter(
+                    pk__in=SharedCart.cart_positions.through.objects.filter(
+                        sharedcart_id__in=pks
+                    ).values('cartposition_id')
+                ).delete()[1].get(CartPosition._meta.label, 0)
+                deleted_carts += SharedCart.objects.filter(pk__in=pks).delete()[1].get(SharedCart._meta.label, 0)
+                log_carts(SharedCartLogEntry.ACTION_EXPIRED, [(event_id, cart_id) for pk, event_id, cart_id in chunk])
+
+        if done and len(unopened) < chunk_size:
+            due = SharedCart.objects.aggregate(
+                expires=Min('expires'),
+                release=Min('release_unopened_at', filter=Q(reserved=True, opened__isnull=True)),
+            )
+            next_expiry = min((d for d in due.values() if d is not None), default=None)
+            # Without any carts left, nothing can expire before a new one is created, which resets the cache
+            cache.set(NEXT_EXPIRY_CACHE_KEY, next_expiry.timestamp() if next_expiry else float('inf'),
+                      NEXT_EXPIRY_CACHE_TIMEOUT)
+
+    if deleted_carts:
+        logger.info('Deleted %d expired shared carts with %d cart positions.', deleted_carts, deleted_positions)
+    return deleted_carts, deleted_positions
+
+
+# Log entries are only counted once they are older than this, so entries of transactions that are still running
+# when the aggregation reads the highest ID are not skipped
+LOG_AGGREGATION_DELAY = 60
+LOG_AGGREGATION_LOCK_KEY = 'pretix_cartshare_log_aggregation_lock'
+LOG_AGGREGATION_LOCK_TIMEOUT = 600
+
+
 @receiver(signal=periodic_task)
 @scopes_disabled()
-def clean_cart_positions(sender, **kwargs):
-    for sc in SharedCart.objects.filter(expires__lt=now()):
-        sc.positions.delete()
-        sc.delete()
+def aggregate_log_entries(sender, **kwargs):
+    """
+    Adds the log entries written since the last run to the per-event counters of every action. The ID of the
+    last counted entry is kept in the global settings, so every run only reads the new entries with one
+    aggregating query and updates one counter row per event and action. Returns the number of counted entries.
+
+    A run holds a lock in the cache from reading the ID until storing the new one. A run that starts while
+    another one holds the lock does nothing, so overlapping runs cannot count the same entries twice.
+    """
+    if not cache.add(LOG_AGGREGATION_LOCK_KEY, True, LOG_AGGREGATION_LOCK_TIMEOUT):
+        return 0
+    try:
+        return _aggregate_log_entries()
+    finally:
+        cache.delete(LOG_AGGREGATION_LOCK_KEY)
+
+
+def _aggregate_log_entries():
+    gs = GlobalSettingsObject()
+    last_id = gs.settings.get('cartshare_log_aggregated', as_type=int, default=0)
+    new = SharedCartLogEntry.objects.filter(
+        pk__gt=last_id, datetime__lt=now() - timedelta(seconds=LOG_AGGREGATION_DELAY)
+    )
+    max_id = new.aggregate(m=Max('pk'))['m']
+    if max_id is None:
+        return 0
+
+    counted = 0
+    with transaction.atomic():
+        for row in SharedCartLogEntry.objects.filter(pk__gt=last_id, pk__lte=max_id).values(
+            'event_id', 'action'
+        ).annotate(count=Count('pk')).order_by():
+            updated = SharedCartCounter.objects.filter(event_id=row['event_id'], action=row['action']).update(
+                count=F('count') + row['count']
+            )
+            if not updated:
+                SharedCartCounter.objects.create(event_id=row['event_id'], action=row['action'], count=row['count'])
+            counted += row['count']
+        gs.settings.set('cartshare_log_aggregated', max_id)
+    return counted
@@ -0,0 +1,57 @@
+/*global $, gettext, interpolate*/
+$(function () {
+    var $form = $("#cartshare-create-form"),
+        $box = $("#cartshare-availability"),
+        timeout = null,
+        request = null;
+
+    if (!$form.length) {
+        return;
+    }
+
+    function render(data) {
+        $box.empty();
+        if (data.error) {
+            $box.append($("<div>").addClass("alert alert-warning").text(data.error));
+            return;
+        }
+        var missing = $.grep(data.quotas, function (q) { return !q.sufficient; });
+        if (!missing.length) {
+            return;
+        }
+        var $alert = $("<div>").addClass("alert alert-warning").append(
+            $("<p>").text(gettext("Based on the current availability, this cart can probably not be created:"))
+        );
+        var $list = $("<ul>");
+        $.each(missing, function (i, q) {
+            $list.append($("<li>").text(interpolate(
+                gettext("%(name)s: %(requested)s requested, %(available)s available"),
+                {"name": q.name, "requested": q.requested, "available": q.available},
+                true
+            )));
+        });
+        $box.append($alert.append($list));
+    }
+
+    function check() {
+        if (request) {
+            request.abort();
+        }
+        if ($("#id_reserve_on_redemption").prop("checked")) {
+            $box.empty();
+            return;
+        }
+        request = $.ajax({
+            "method": "POST",
+            "url": $box.attr("data-url"),
+            "data": $form.serialize(),
+            "dataType": "json",
+            "success": render
+        });
+    }
+
+    $form.on("change", "input, select", function () {
+        window.clearTimeout(timeout);
+        timeout = window.setTimeout(check, 300);
+    });
+});
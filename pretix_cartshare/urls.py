@@ -1,14 +1,31 @@
 from django.conf.urls import url
+from pretix.api.urls import event_router
 
+from .api import SharedCartViewSet
 from .views import (
-    CartShareCreateView, CartShareDeleteView, CartShareListView, RedeemView,
+    CartShareAvailabilityView, CartShareBulkActionView, CartShareCreateView,
+    CartShareDeleteView, CartShareExportView, CartShareImportView,
+    CartShareItemVarSelect2View, CartShareListView, CartShareStatsView,
+    RedeemView,
 )
 
 urlpatterns = [
     url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/$',
         CartShareListView.as_view(), name='list'),
+    url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/bulk/$',
+        CartShareBulkActionView.as_view(), name='bulk'),
     url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/create/$',
         CartShareCreateView.as_view(), name='create'),
+    url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/create/availability/$',
+        CartShareAvailabilityView.as_view(), name='create.availability'),
+    url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/create/itemvars/$',
+        CartShareItemVarSelect2View.as_view(), name='create.itemvars'),
+    url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/import/$',
+        CartShareImportView.as_view(), name='import'),
+    url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/export/$',
+        CartShareExportView.as_view(), name='export'),
+    url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/stats/$',
+        CartShareStatsView.as_view(), name='stats'),
     url(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/cartshare/(?P<id>[^/]+)/delete$',
         CartShareDeleteView.as_view(), name='delete'),
 ]
@@ -16,3 +33,5 @@ urlpatterns = [
 event_patterns = [
     url(r'^sharedcart/(?P<id>[^/]+)/', RedeemView.as_view(), name='redeem'),
 ]
+
+event_router.register(r'sharedcarts', SharedCartViewSet)
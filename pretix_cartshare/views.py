@@ -1,57 +1,204 @@
-from collections import Counter
 from datetime import timedelta
 
+from defusedcsv import csv
+from django.conf import settings
 from django.contrib import messages
 from django.db import transaction
-from django.http import Http404, HttpResponseRedirect
+from django.db.models import F
+from django.http import (
+    Http404, HttpResponse, HttpResponseRedirect, JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import redirect
+from django.template.loader import render_to_string
+from django.template.response import TemplateResponse
 from django.urls import reverse
+from django.utils import translation
 from django.utils.functional import cached_property
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
-from django.views.generic import DeleteView, FormView, ListView, TemplateView
-from pretix.base.models import CartPosition, Item, ItemVariation, Quota
+from django.views.generic import (
+    DeleteView, FormView, ListView, TemplateView, View,
+)
 from pretix.base.services.cart import CartError
+from pretix.base.views.tasks import AsyncAction
 from pretix.control.permissions import EventPermissionRequiredMixin
+from pretix.control.views import LargeResultSetPaginator
+from pretix.helpers.http import get_client_ip
 from pretix.multidomain.urlreverse import build_absolute_uri, eventreverse
 from pretix.presale.views import CartMixin
 from pretix.presale.views.cart import get_or_create_cart_id
 
-from .forms import CartPositionFormSet, SharedCartForm
-from .models import SharedCart
+from .exporters import export_csv, export_json
+from .forms import (
+    CartPositionFormSet, SharedCartBulkActionForm, SharedCartFilterForm,
+    SharedCartForm, SharedCartImportForm, get_itemvar_choices,
+)
+from .metrics import measure, pretix_cartshare_redeem_rejected
+from .models import (
+    SharedCart, SharedCartCounter, SharedCartLogEntry, is_valid_cart_id,
+)
+from .ratelimit import record_failure, retry_after
+from .services import (
+    bulk_action, claim_shared_cart, create_shared_cart, create_shared_carts,
+    estimate_availability, log_carts, parse_itemvar, redeem_shared_cart,
+    resolve_lines, run_bulk_action,
+)
 
 
 class CartShareListView(EventPermissionRequiredMixin, ListView):
+    """
+    Lists the active shared carts of an event. Pages are fetched without counting all matching carts first, as
+    counting becomes expensive for events with very many carts.
+    """
     model = SharedCart
     context_object_name = 'carts'
     paginate_by = 25
+    paginator_class = LargeResultSetPaginator
     template_name = 'pretixplugins/cartshare/list.html'
     permission = 'can_change_orders'
 
+    @cached_property
+    def filter_form(self):
+        return SharedCartFilterForm(data=self.request.GET, event=self.request.event)
+
     def get_queryset(self):
-        qs = SharedCart.objects.filter(event=self.request.event, expires__gte=now()).order_by('-datetime')
+        qs = SharedCart.objects.filter(event=self.request.event, expires__gte=now()).select_related(
+            'subevent'
+        ).order_by('-datetime', '-pk')
+        if self.filter_form.is_valid():
+            qs = self.filter_form.filter_qs(qs)
         return qs
 
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx['filter_form'] = self.filter_form
+        # Reverse the URLs once with a placeholder instead of once per row
+        redeem_url = eventreverse(self.request.event, 'plugins:pretix_cartshare:redeem', kwargs={'id': '_ID_'})
+        delete_url = reverse('plugins:pretix_cartshare:delete', kwargs={
+            'event': self.request.event.slug,
+            'organizer': self.request.organizer.slug,
+            'id': '_ID_',
+        })
+        for cart in ctx['carts']:
+            cart.redeem_url = redeem_url.replace('_ID_', cart.cart_id)
+            cart.delete_url = delete_url.replace('_ID_', cart.cart_id)
+        return ctx
 
-class CartShareCreateView(EventPermissionRequiredMixin, FormView):
+
+class CartShareBulkActionView(EventPermissionRequiredMixin, AsyncAction, FormView):
+    """
+    Runs a bulk action on the carts selected in the list view, or on all active carts of the event that match
+    the filter of the list view. Large selections are processed in the background. Deleting needs to be
+    confirmed on a page that shows the number of affected carts first.
+    """
+    permission = 'can_change_orders'
+    form_class = SharedCartBulkActionForm
+    task = run_bulk_action
+    known_errortypes = ['CartError']
+
+    def get(self, request, *args, **kwargs):
+        if 'async_id' in request.GET and settings.HAS_CELERY:
+            return self.get_result(request)
+        return redirect(self.get_error_url())
+
+    def get_success_url(self, value=None):
+        return reverse('plugins:pretix_cartshare:list', kwargs={
+            'event': self.request.event.slug,
+            'organizer': self.request.organizer.slug,
+        })
+
+    def get_error_url(self):
+        return self.get_success_url()
+
+    def get_success_message(self, value):
+        return _('The selected carts have been updated.')
+
+    def form_invalid(self, form):
+        messages.error(self.request, _('Your input was invalid'))
+        return redirect(self.get_error_url())
+
+    def form_valid(self, form):
+        carts = SharedCart.objects.filter(event=self.request.event, expires__gte=now())
+        filters = None
+        if self.request.POST.get('all') == 'on':
+            cart_ids = None
+            filter_form = SharedCartFilterForm(data=self.request.POST, event=self.request.event)
+            if not filter_form.is_valid():
+                return self.form_invalid(form)
+            filters = {k: v for k, v in filter_form.data.items() if k in filter_form.fields and v}
+            carts = filter_form.filter_qs(carts)
+        else:
+            cart_ids = [int(pk) for pk in self.request.POST.getlist('cart') if pk.isdigit()]
+            carts = carts.filter(pk__in=cart_ids)
+            if not cart_ids:
+                messages.error(self.request, _('You did not select any carts.'))
+                return redirect(self.get_error_url())
+
+        if form.cleaned_data['action'] == 'delete' and not form.cleaned_data['confirmed']:
+            return TemplateResponse(self.request, 'pretixplugins/cartshare/bulk_delete.html', {
+                'count': carts.count(),
+                'data': [
+                    (key, value) for key, values in self.request.POST.lists() if key != 'csrfmiddlewaretoken'
+                    for value in values
+                ],
+            })
+
+        async_threshold = getattr(settings, 'CARTSHARE_BULK_ASYNC_THRESHOLD', 500)
+        if async_threshold is not None and carts.count() >= async_threshold:
+            return self.do(
+                self.request.event.pk,
+                action=form.cleaned_data['action'],
+                cart_ids=cart_ids,
+                expires=form.cleaned_data['expires'].isoformat() if form.cleaned_data['expires'] else None,
+                filters=filters,
+            )
+
+        bulk_action(self.request.event, carts, form.cleaned_data['action'], form.cleaned_data['expires'])
+        messages.success(self.request, self.get_success_message(None))
+        return redirect(self.get_success_url())
+
+
+class CartShareCreateView(EventPermissionRequiredMixin, AsyncAction, FormView):
     template_name = 'pretixplugins/cartshare/create.html'
     permission = 'can_change_orders'
     form_class = SharedCartForm
-    error_messages = {
-        'quota': _('The quota {name} does not have enough capacity left to perform the operation.'),
-    }
+    task = create_shared_cart
+    known_errortypes = ['CartError']
 
-    def get_success_url(self):
+    def get(self, request, *args, **kwargs):
+        if 'async_id' in request.GET and settings.HAS_CELERY:
+            return self.get_result(request)
+        return FormView.get(self, request, *args, **kwargs)
+
+    def get_success_url(self, value=None):
         return reverse('plugins:pretix_cartshare:list', kwargs={
             'event': self.request.event.slug,
             'organizer': self.request.organizer.slug,
         })
 
+    def get_error_url(self):
+        return reverse('plugins:pretix_cartshare:create', kwargs={
+            'event': self.request.event.slug,
+            'organizer': self.request.organizer.slug,
+        })
+
+    def get_success_message(self, value):
+        url = build_absolute_uri(self.request.event, 'plugins:pretix_cartshare:redeem', kwargs={
+            'id': value
+        })
+        return _('The cart has been saved. You can now share the following URL: {url}').format(url=url)
+
     def get_initial(self):
         initial = super().get_initial()
         initial['expires'] = now() + timedelta(days=14)
         return initial
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['event'] = self.request.event
+        return kwargs
+
     @cached_property
     def formset(self):
         return CartPositionFormSet(self.request.POST if self.request.method == "POST" else None,
@@ -68,57 +215,170 @@ class CartShareCreateView(EventPermissionRequiredMixin, FormView):
             messages.error(self.request, _('Your input was invalid'))
             return self.get(self.request, *self.args, **self.kwargs)
 
+        lines = [
+            parse_itemvar(form.cleaned_data['itemvar']) + (form.cleaned_data['count'], form.cleaned_data['price'])
+            for form in self.formset.forms
+        ]
+        async_threshold = getattr(settings, 'CARTSHARE_ASYNC_THRESHOLD', 100)
+        if (async_threshold is not None and form.cleaned_data['reserved']
+                and sum(line[2] for line in lines) >= async_threshold):
+            return self.do(
+                self.request.event.pk,
+                cart_id=form.instance.cart_id,
+                expires=form.cleaned_data['expires'].isoformat(),
+                lines=[[itemid, varid, count, str(price) if price else None] for itemid, varid, count, price in lines],
+                locale=translation.get_language(),
+                release_unopened_at=(form.cleaned_data['release_unopened_at'].isoformat()
+                                     if form.cleaned_data['release_unopened_at'] else None),
+                subevent=form.instance.subevent_id,
+            )
+
         try:
-            self.create_cart(form.instance, form.cleaned_data['expires'])
+            self.create_cart(form.instance, form.cleaned_data['expires'], lines)
         except CartError as e:
             messages.error(self.request, str(e))
-            return super().get(self.request, *self.args, **self.kwargs)
+            return FormView.get(self, self.request, *self.args, **self.kwargs)
         else:
-            url = build_absolute_uri(self.request.event, 'plugins:pretix_cartshare:redeem', kwargs={
-                'id': form.instance.cart_id
-            })
-            messages.success(self.request, _('The cart has been saved. You can now share the following URL: '
-                                             '{url}').format(url=url))
+            messages.success(self.request, self.get_success_message(form.instance.cart_id))
             return super().form_valid(form)
 
-    def create_cart(self, sc, expires):
-        with transaction.atomic():
-            with self.request.event.lock():
-                positions = []
-                quotas = Counter()
-
-                for form in self.formset.forms:
-                    if '-' in form.cleaned_data['itemvar']:
-                        itemid, varid = form.cleaned_data['itemvar'].split('-')
-                    else:
-                        itemid, varid = form.cleaned_data['itemvar'], None
-
-                    item = Item.objects.get(pk=itemid, event=self.request.event)
-                    variation = ItemVariation.objects.get(pk=varid, item=item) if varid else None
-                    price = form.cleaned_data['price']
-                    if not price:
-                        price = (variation.default_price if variation and variation.default_price is not None
-                                 else item.default_price)
-
-                    for quota in item.quotas.all():
-                        quotas[quota] += form.cleaned_data['count']
-
-                    for i in range(form.cleaned_data['count']):
-                        positions.append(CartPosition(
-                            item=item, variation=variation, event=self.request.event, cart_id=sc.cart_id,
-                            expires=expires, price=price
-                        ))
-
-                for quota, diff in quotas.items():
-                    avail = quota.availability()
-                    if avail[0] != Quota.AVAILABILITY_OK or (avail[1] is not None and avail[1] < diff):
-                        raise CartError(self.error_messages['quota'].format(name=quota.name))
-
-                sc.expires = expires
-                sc.event = self.request.event
-                sc.total = sum([p.price for p in positions])
-                sc.save()
-                CartPosition.objects.bulk_create(positions)
+    def create_cart(self, sc, expires, lines):
+        create_shared_carts(self.request.event, [(sc, resolve_lines(self.request.event, lines, sc.subevent))],
+                            expires)
+
+
+class CartShareItemVarSelect2View(EventPermissionRequiredMixin, View):
+    """
+    Returns the active products and variations matching a search term for the product selects of the create
+    page, page by page in the format expected by select2. The choices are read from the cached list of
+    :py:func:`get_itemvar_choices`, so typing does not cause database queries.
+    """
+    permission = 'can_change_orders'
+    page_size = 20
+
+    def get(self, request, *args, **kwargs):
+        words = request.GET.get('query', '').lower().split()
+        try:
+            page = max(int(request.GET.get('page', '1')), 1)
+        except ValueError:
+            page = 1
+
+        choices = [
+            (value, label) for value, label in get_itemvar_choices(request.event)
+            if all(word in label.lower() for word in words)
+        ]
+        offset = (page - 1) * self.page_size
+        return JsonResponse({
+            'results': [
+                {'id': value, 'text': label}
+                for value, label in choices[offset:offset + self.page_size]
+            ],
+            'pagination': {
+                'more': len(choices) > offset + self.page_size
+            }
+        })
+
+
+class CartShareAvailabilityView(EventPermissionRequiredMixin, View):
+    """
+    Estimates the quota availability for the products currently entered on the create page, so the page can
+    warn before the form is submitted. Lines that are incomplete or invalid are ignored.
+    """
+    permission = 'can_change_orders'
+
+    @cached_property
+    def subevent(self):
+        subevent = self.request.POST.get('subevent', '')
+        if not self.request.event.has_subevents or not subevent.isdigit():
+            return None
+        return self.request.event.subevents.filter(pk=subevent).first()
+
+    def post(self, request, *args, **kwargs):
+        formset = CartPositionFormSet(request.POST, event=request.event)
+        if not formset.management_form.is_valid():
+            return JsonResponse({'error': 'Invalid formset.'}, status=400)
+        lines = [
+            parse_itemvar(f.cleaned_data['itemvar']) + (f.cleaned_data['count'], None)
+            for f in formset.forms
+            if f.is_valid() and f.cleaned_data.get('itemvar') and f.cleaned_data.get('count')
+            and not f.cleaned_data.get('DELETE')
+        ]
+        try:
+            quotas = estimate_availability(request.event, resolve_lines(request.event, lines, self.subevent))
+        except CartError as e:
+            return JsonResponse({'sufficient': False, 'error': str(e), 'quotas': []})
+        return JsonResponse({
+            'sufficient': all(sufficient for quota, requested, available, sufficient in quotas),
+            'quotas': [
+                {
+                    'name': quota.name,
+                    'requested': requested,
+                    'available': available,
+                    'sufficient': sufficient,
+                }
+                for quota, requested, available, sufficient in quotas
+            ]
+        })
+
+
+class CartShareImportView(EventPermissionRequiredMixin, FormView):
+    template_name = 'pretixplugins/cartshare/import.html'
+    permission = 'can_change_orders'
+    form_class = SharedCartImportForm
+
+    def get_initial(self):
+        initial = super().get_initial()
+        initial['expires'] = now() + timedelta(days=14)
+        return initial
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['event'] = self.request.event
+        return kwargs
+
+    @transaction.atomic
+    def form_valid(self, form):
+        carts = form.cleaned_data['file']
+        subevent = form.cleaned_data.get('subevent')
+        try:
+            resolved = iter(resolve_lines(self.request.event, [line for lines in carts.values() for line in lines],
+                                          subevent))
+            shared_carts = [
+                (reference, SharedCart(subevent=subevent), [next(resolved) for line in lines])
+                for reference, lines in carts.items()
+            ]
+            create_shared_carts(self.request.event, [(sc, lines) for reference, sc, lines in shared_carts],
+                                form.cleaned_data['expires'])
+        except CartError as e:
+            messages.error(self.request, str(e))
+            return self.form_invalid(form)
+
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="{}-sharedcarts.csv"'.format(self.request.event.slug)
+        writer = csv.writer(response)
+        writer.writerow(['reference', 'cart_id', 'total', 'url'])
+        for reference, sc, lines in shared_carts:
+            writer.writerow([
+                reference, sc.cart_id, sc.total,
+                build_absolute_uri(self.request.event, 'plugins:pretix_cartshare:redeem', kwargs={'id': sc.cart_id})
+            ])
+        return response
+
+
+class CartShareExportView(EventPermissionRequiredMixin, View):
+    permission = 'can_view_orders'
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('format') == 'json':
+            response = StreamingHttpResponse(export_json(request.event), content_type='application/json')
+            extension = 'json'
+        else:
+            response = StreamingHttpResponse(export_csv(request.event), content_type='text/csv')
+            extension = 'csv'
+        response['Content-Disposition'] = 'attachment; filename="{}-sharedcarts.{}"'.format(
+            request.event.slug, extension
+        )
+        return response
 
 
 class CartShareDeleteView(EventPermissionRequiredMixin, DeleteView):
@@ -142,6 +402,8 @@ class CartShareDeleteView(EventPermissionRequiredMixin, DeleteView):
         success_url = self.get_success_url()
         self.object.positions.delete()
         self.object.delete()
+        log_carts(SharedCartLogEntry.ACTION_DELETED, [(self.object.event_id, self.object.cart_id)])
+        self.object.clear_cache()
         messages.success(request, _('The selected cart has been deleted.'))
         return HttpResponseRedirect(success_url)
 
@@ -152,13 +414,35 @@ class CartShareDeleteView(EventPermissionRequiredMixin, DeleteView):
         })
 
 
+class CartShareStatsView(EventPermissionRequiredMixin, TemplateView):
+    """
+    Shows how many shared carts were created, opened, redeemed, deleted or expired. The numbers are read from
+    the counters that the periodic task keeps up to date, so the page does not need to scan the log and may
+    lag behind by a few minutes.
+    """
+    template_name = 'pretixplugins/cartshare/stats.html'
+    permission = 'can_view_orders'
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        counts = dict(SharedCartCounter.objects.filter(event=self.request.event).values_list('action', 'count'))
+        created = counts.get(SharedCartLogEntry.ACTION_CREATED, 0)
+        ctx['rows'] = [
+            (label, counts.get(action, 0), counts.get(action, 0) / created * 100 if created else None)
+            for action, label in SharedCartLogEntry.ACTIONS
+        ]
+        return ctx
+
+
 class RedeemView(CartMixin, TemplateView):
     template_name = 'pretixplugins/cartshare/redeem.html'
 
     @cached_property
     def object(self):
         try:
-            return SharedCart.objects.get(
+            return SharedCart.objects.exclude(
+                max_redemptions__isnull=False, redemptions__gte=F('max_redemptions')
+            ).get(
                 event=self.request.event,
                 cart_id=self.kwargs['id'],
                 expires__gte=now()
@@ -166,21 +450,107 @@ class RedeemView(CartMixin, TemplateView):
         except SharedCart.DoesNotExist:
             raise Http404()
 
+    @cached_property
+    def positions(self):
+        # Only used for carts that do not reserve their products, as they do not have any stored positions
+        return self.object.build_positions()
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_valid_cart_id(kwargs['id']):
+            pretix_cartshare_redeem_rejected.inc(reason='malformed')
+            raise Http404()
+
+        ip = get_client_ip(request)
+        wait = retry_after(ip)
+        if wait:
+            pretix_cartshare_redeem_rejected.inc(reason='rate_limited')
+            r = HttpResponse(_('You tried to open too many invalid links. Please try again later.'), status=429)
+            r['Retry-After'] = wait
+            return r
+
+        with measure('redeem', request.method.lower(), request.event):
+            try:
+                return super().dispatch(request, *args, **kwargs)
+            except Http404:
+                pretix_cartshare_redeem_rejected.inc(reason='not_found')
+                record_failure(ip)
+                raise
+
     def get_cart(self, answers=False, queryset=None, payment_fee=None, payment_fee_tax_rate=None):
-        queryset = self.object.positions
-        return super().get_cart(answers, queryset, 0, 0)
+        queryset = self.object.positions if self.object.reserved else None
+        cart = super().get_cart(answers, queryset, 0, 0)
+        # Fees depend on the session of the visitor, e.g. on gift cards, the payment method or the invoice address.
+        # The preview is cached and shown to everybody, so it only contains the products.
+        fees = cart['fees']
+        cart.update(
+            fees=[],
+            total=cart['total'] - sum(f.value for f in fees),
+            net_total=cart['net_total'] - sum(f.net_value for f in fees),
+            tax_total=cart['tax_total'] - sum(f.tax_value for f in fees),
+        )
+        return cart
+
+    def get_cart_html(self):
+        """
+        Returns the rendered cart summary. The summary is cached in the event cache, whose namespace pretix
+        replaces whenever the event or its products change, until the cart expires. Unknown or expired
+        cart IDs are remembered for a short time as well, so repeated lookups do not reach the database.
+
+        The first time the summary is rendered, the cart is marked as opened, which keeps its reservation from
+        being released.
+        """
+        cache = self.request.event.cache
+        missing_key = 'cartshare_redeem_missing_{}'.format(self.kwargs['id'])
+        key = 'cartshare_redeem_{}_{}'.format(self.kwargs['id'], translation.get_language())
+        cached = cache.get_many([key, missing_key])
+        if cached.get(missing_key):
+            raise Http404()
+        if cached.get(key):
+            return cached[key]
+
+        try:
+            sc = self.object
+        except Http404:
+            cache.set(missing_key, True, getattr(settings, 'CARTSHARE_REDEEM_MISSING_CACHE_TIMEOUT', 60))
+            raise
+
+        if sc.opened is None and SharedCart.objects.filter(pk=sc.pk, opened__isnull=True).update(opened=now()):
+            log_carts(SharedCartLogEntry.ACTION_VIEWED, [(sc.event_id, sc.cart_id)])
+
+        html = render_to_string('pretixpresale/event/fragment_cart.html', {
+            'cart': self.get_cart(),
+            'event': self.request.event,
+            'editable': False,
+        }, request=self.request)
+        timeout = min(getattr(settings, 'CARTSHARE_REDEEM_CACHE_TIMEOUT', 3600), (sc.expires - now()).total_seconds())
+        if timeout >= 1:
+            cache.set(key, html, int(timeout))
+        return html
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data()
         ctx['event'] = self.request.event
-        ctx['cart'] = self.get_cart()
+        ctx['cart_html'] = self.get_cart_html()
         return ctx
 
     def post(self, request, *args, **kwargs):
-        now_dt = now()
-        expiry = now_dt + timedelta(minutes=request.event.settings.get('reservation_time', as_type=int))
+        expiry = now() + timedelta(minutes=request.event.settings.get('reservation_time', as_type=int))
         cart_id = get_or_create_cart_id(request)
-        with transaction.atomic():
-            self.object.positions.update(expires=expiry, cart_id=cart_id)
-            self.object.delete()
+        sc = self.object
+        try:
+            if sc.reserved:
+                try:
+                    claim_shared_cart(request.event, sc, cart_id, expiry)
+                except CartError:
+                    # The cleanup may have released the reservation since the cart was read. The cart can then
+                    # still be redeemed like a cart that does not reserve its products.
+                    released = SharedCart.objects.filter(pk=sc.pk, reserved=False).first()
+                    if not released:
+                        raise
+                    redeem_shared_cart(request.event, released, cart_id, expiry)
+            else:
+                redeem_shared_cart(request.event, sc, cart_id, expiry)
+        except CartError as e:
+            messages.error(request, str(e))
+            return redirect(eventreverse(request.event, 'presale:event.index'))
         return redirect(eventreverse(request.event, 'presale:event.checkout.start'))
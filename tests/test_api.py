@@ -0,0 +1,170 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import CartPosition, Event, Organizer, Team
+from pretix_cartshare.models import SharedCart, SharedCartLogEntry
+from rest_framework.test import APIClient
+
+
+@pytest.fixture
+@scopes_disabled()
+def env():
+    o = Organizer.objects.create(name='Dummy', slug='dummy')
+    event = Event.objects.create(
+        organizer=o, name='Dummy', slug='dummy',
+        date_from=now(), plugins='pretix_cartshare'
+    )
+    t = Team.objects.create(organizer=o, can_change_orders=True, can_view_orders=True)
+    t.limit_events.add(event)
+    token = t.tokens.create(name='Foo')
+    ticket = event.items.create(default_price=Decimal('12'), name='Ticket')
+    return event, token, ticket
+
+
+@pytest.fixture
+def client(env):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + env[1].token)
+    return client
+
+
+def _create_carts(event, ticket, count, positions=2, expires=None):
+    carts = []
+    with scopes_disabled():
+        for i in range(count):
+            sc = SharedCart.objects.create(total=Decimal('24'), expires=expires or now() + timedelta(days=3),
+                                           event=event)
+            for j in range(positions):
+                sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('12'), item=ticket,
+                                                                  expires=sc.expires))
+            carts.append(sc)
+    return carts
+
+
+@pytest.mark.django_db
+def test_list(client, env):
+    event, token, ticket = env
+    sc, = _create_carts(event, ticket, 1)
+    r = client.get('/api/v1/organizers/dummy/events/dummy/sharedcarts/')
+    assert r.status_code == 200
+    res = r.data['results']
+    assert len(res) == 1
+    assert res[0]['cart_id'] == sc.cart_id
+    assert res[0]['url'].endswith('/dummy/dummy/sharedcart/%s/' % sc.cart_id)
+    assert [p['item'] for p in res[0]['positions']] == [ticket.pk, ticket.pk]
+
+
+@pytest.mark.django_db
+def test_list_cursor_pagination_and_filter(client, env):
+    event, token, ticket = env
+    carts = _create_carts(event, ticket, 5, positions=0)
+    _create_carts(event, ticket, 2, positions=0, expires=now() - timedelta(days=1))
+    seen = []
+    url = '/api/v1/organizers/dummy/events/dummy/sharedcarts/?page_size=2&expires_after=%s' % (
+        now().isoformat().replace('+', '%2B')
+    )
+    while url:
+        r = client.get(url)
+        assert r.status_code == 200
+        seen += [c['cart_id'] for c in r.data['results']]
+        url = r.data['next']
+    assert seen == [sc.cart_id for sc in reversed(carts)]
+
+
+@pytest.mark.django_db
+def test_list_queries_constant(client, env):
+    event, token, ticket = env
+    _create_carts(event, ticket, 2)
+    client.get('/api/v1/organizers/dummy/events/dummy/sharedcarts/')
+    with CaptureQueriesContext(connection) as ctx_few:
+        client.get('/api/v1/organizers/dummy/events/dummy/sharedcarts/')
+    _create_carts(event, ticket, 20)
+    with CaptureQueriesContext(connection) as ctx_many:
+        r = client.get('/api/v1/organizers/dummy/events/dummy/sharedcarts/')
+    assert len(r.data['results']) == 22
+    assert len(ctx_many.captured_queries) == len(ctx_few.captured_queries)
+
+
+@pytest.mark.django_db
+def test_retrieve_and_delete(client, env):
+    event, token, ticket = env
+    sc, = _create_carts(event, ticket, 1)
+    r = client.get('/api/v1/organizers/dummy/events/dummy/sharedcarts/%s/' % sc.cart_id)
+    assert r.status_code == 200
+    assert len(r.data['positions']) == 2
+    r = client.delete('/api/v1/organizers/dummy/events/dummy/sharedcarts/%s/' % sc.cart_id)
+    assert r.status_code == 204
+    assert not SharedCart.objects.exists()
+    with scopes_disabled():
+        assert not CartPosition.objects.exists()
+    assert SharedCartLogEntry.objects.filter(cart_id=sc.cart_id, action='deleted').exists()
+
+
+@pytest.mark.django_db
+def test_create(client, env):
+    event, token, ticket = env
+    r = client.post('/api/v1/organizers/dummy/events/dummy/sharedcarts/', {
+        'expires': (now() + timedelta(days=3)).isoformat(),
+        'positions': [{'item': ticket.pk, 'count': 2}, {'item': ticket.pk, 'price': '10.00'}]
+    }, format='json')
+    assert r.status_code == 201
+    assert r.data['total'] == '34.00'
+    assert len(r.data['positions']) == 3
+    assert SharedCart.objects.get().cart_id == r.data['cart_id']
+
+
+@pytest.mark.django_db
+def test_create_bulk_quota_exceeded(client, env):
+    event, token, ticket = env
+    with scopes_disabled():
+        event.quotas.create(size=3, name='Test').items.add(ticket)
+    r = client.post('/api/v1/organizers/dummy/events/dummy/sharedcarts/', [
+        {'expires': (now() + timedelta(days=3)).isoformat(), 'positions': [{'item': ticket.pk, 'count': 2}]},
+        {'expires': (now() + timedelta(days=3)).isoformat(), 'positions': [{'item': ticket.pk, 'count': 2}]},
+    ], format='json')
+    assert r.status_code == 400
+    assert not SharedCart.objects.exists()
+
+
+@pytest.mark.django_db
+def test_create_bulk(client, env):
+    event, token, ticket = env
+    r = client.post('/api/v1/organizers/dummy/events/dummy/sharedcarts/', [
+        {'expires': (now() + timedelta(days=3)).isoformat(), 'positions': [{'item': ticket.pk, 'count': 2}]},
+        {'expires': (now() + timedelta(days=5)).isoformat(), 'positions': [{'item': ticket.pk}]},
+    ], format='json')
+    assert r.status_code == 201
+    assert [len(c['positions']) for c in r.data] == [2, 1]
+    assert SharedCart.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_create_subevent(client, env):
+    event, token, ticket = env
+    with scopes_disabled():
+        event.has_subevents = True
+        event.save()
+        se1 = event.subevents.create(name='Day 1', date_from=now())
+        se2 = event.subevents.create(name='Day 2', date_from=now())
+        event.quotas.create(size=1, name='Day 1', subevent=se1).items.add(ticket)
+        event.quotas.create(size=5, name='Day 2', subevent=se2).items.add(ticket)
+    cart = {'expires': (now() + timedelta(days=3)).isoformat(), 'positions': [{'item': ticket.pk, 'count': 2}]}
+
+    r = client.post('/api/v1/organizers/dummy/events/dummy/sharedcarts/', cart, format='json')
+    assert r.status_code == 400
+    r = client.post('/api/v1/organizers/dummy/events/dummy/sharedcarts/', dict(cart, subevent=se2.pk + 100),
+                    format='json')
+    assert r.status_code == 400
+    r = client.post('/api/v1/organizers/dummy/events/dummy/sharedcarts/', [
+        dict(cart, subevent=se2.pk), dict(cart, subevent=se1.pk, positions=[{'item': ticket.pk}]),
+    ], format='json')
+    assert r.status_code == 201
+    assert [c['subevent'] for c in r.data] == [se2.pk, se1.pk]
+    with scopes_disabled():
+        assert sorted(CartPosition.objects.values_list('subevent_id', flat=True)) == sorted([se2.pk, se2.pk, se1.pk])
+    assert not SharedCart.objects.filter(subevent__isnull=True).exists()
@@ -0,0 +1,216 @@
+"""
+Query count and timing benchmarks for the views and tasks of this plugin. Every benchmark runs against an event
+with many products, variations, quotas and shared carts and fails if it needs more database queries than the
+recorded baseline. Timings are reported as test properties, e.g. with ``pytest --junitxml``. If a change
+legitimately needs more queries, update ``BASELINES`` in the same commit.
+"""
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Organizer, Team, User
+from pretix_cartshare.models import SharedCart
+from pretix_cartshare.services import create_shared_carts, resolve_lines
+from pretix_cartshare.signals import clean_cart_positions
+
+# Recorded on SQLite, which splits bulk inserts of many rows into several statements, with a local memory cache
+BASELINES = {
+    'list': 8,
+    'create_1': 37,
+    'create_10': 37,
+    'create_100': 39,
+    'redeem_get': 9,
+    'redeem_post': 15,
+    'redeem_template_get': 14,
+    'redeem_template_post': 35,
+    'delete': 21,
+    'cleanup': 20,
+    'cleanup_idle': 0,
+}
+
+ITEMS = 30
+VARIATIONS = 3
+QUOTAS = 10
+CARTS = 200
+TEMPLATE_LINES = 5
+
+
+@pytest.fixture(autouse=True)
+def local_cache(settings):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+
+
+@pytest.fixture
+@scopes_disabled()
+def env():
+    o = Organizer.objects.create(name='Dummy', slug='dummy')
+    event = Event.objects.create(
+        organizer=o, name='Dummy', slug='dummy', live=True,
+        date_from=now(), plugins='pretix_cartshare'
+    )
+    user = User.objects.create_user('dummy@dummy.dummy', 'dummy')
+    t = Team.objects.create(organizer=o, can_change_orders=True, can_view_orders=True)
+    t.members.add(user)
+    t.limit_events.add(event)
+
+    quotas = [event.quotas.create(name='Quota %d' % i, size=100000) for i in range(QUOTAS)]
+    itemvars = []
+    for i in range(ITEMS):
+        item = event.items.create(name='Product %d' % i, default_price=Decimal('10'))
+        quotas[i % QUOTAS].items.add(item)
+        if i % 3 == 0:
+            for j in range(VARIATIONS):
+                var = item.variations.create(value='Variation %d' % j)
+                quotas[i % QUOTAS].variations.add(var)
+                itemvars.append((item, var))
+        else:
+            itemvars.append((item, None))
+
+    carts = [
+        (SharedCart(expires=now() + timedelta(days=3)), [
+            (item.pk, var.pk if var else None, 1, None)
+            for item, var in (itemvars[(i + j) % len(itemvars)] for j in range(2))
+        ])
+        for i in range(CARTS)
+    ]
+    create_shared_carts(event, [
+        (sc, resolve_lines(event, lines)) for sc, lines in carts
+    ])
+    return event, itemvars
+
+
+def _measure(record_property, name, func):
+    started = time.perf_counter()
+    with CaptureQueriesContext(connection) as ctx:
+        result = func()
+    record_property('%s_seconds' % name, time.perf_counter() - started)
+    record_property('%s_queries' % name, len(ctx.captured_queries))
+    assert len(ctx.captured_queries) <= BASELINES[name], '{} needed {} queries, the baseline is {}'.format(
+        name, len(ctx.captured_queries), BASELINES[name]
+    )
+    return result
+
+
+def _control_url(event, suffix=''):
+    return '/control/event/%s/%s/cartshare/%s' % (event.slug, event.organizer.slug, suffix)
+
+
+def _redeem_url(event, sc):
+    return '/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id)
+
+
+def _create_data(itemvars, lines):
+    data = {
+        'expires': (now() + timedelta(days=14)).strftime("%Y-%m-%d %H:%M:%S"),
+        'form-TOTAL_FORMS': str(lines),
+        'form-INITIAL_FORMS': '0',
+        'form-MIN_NUM_FORMS': '1',
+        'form-MAX_NUM_FORMS': '1000',
+    }
+    for i in range(lines):
+        item, var = itemvars[i % len(itemvars)]
+        data['form-%d-itemvar' % i] = '%d-%d' % (item.pk, var.pk) if var else str(item.pk)
+        data['form-%d-count' % i] = '1'
+        data['form-%d-price' % i] = ''
+    return data
+
+
+@pytest.mark.django_db
+def test_list(client, env, record_property):
+    event, itemvars = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    client.get(_control_url(event))
+    r = _measure(record_property, 'list', lambda: client.get(_control_url(event)))
+    assert r.status_code == 200
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('lines', [1, 10, 100])
+def test_create(client, env, settings, record_property, lines):
+    settings.CARTSHARE_ASYNC_THRESHOLD = None
+    event, itemvars = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    client.post(_control_url(event, 'create/'), _create_data(itemvars, lines))
+    r = _measure(record_property, 'create_%d' % lines,
+                 lambda: client.post(_control_url(event, 'create/'), _create_data(itemvars, lines)))
+    assert r.status_code == 302
+
+
+@pytest.mark.django_db
+def test_redeem_get(client, env, record_property):
+    event, itemvars = env
+    carts = list(SharedCart.objects.order_by('pk')[:2])
+    client.get(_redeem_url(event, carts[0]))
+    r = _measure(record_property, 'redeem_get', lambda: client.get(_redeem_url(event, carts[1])))
+    assert r.status_code == 200
+
+
+@pytest.mark.django_db
+def test_redeem_post(client, env, record_property):
+    event, itemvars = env
+    carts = list(SharedCart.objects.order_by('pk')[:2])
+    client.post(_redeem_url(event, carts[0]))
+    r = _measure(record_property, 'redeem_post', lambda: client.post(_redeem_url(event, carts[1])))
+    assert 'checkout' in r['Location']
+
+
+def _create_templates(event, itemvars, count):
+    carts = [SharedCart(expires=now() + timedelta(days=3), reserved=False) for i in range(count)]
+    with scopes_disabled():
+        create_shared_carts(event, [
+            (sc, resolve_lines(event, [
+                (item.pk, var.pk if var else None, 1, None) for item, var in itemvars[i:i + TEMPLATE_LINES]
+            ]))
+            for i, sc in enumerate(carts)
+        ])
+    return carts
+
+
+@pytest.mark.django_db
+def test_redeem_template_get(client, env, record_property):
+    event, itemvars = env
+    carts = _create_templates(event, itemvars, 2)
+    client.get(_redeem_url(event, carts[0]))
+    r = _measure(record_property, 'redeem_template_get', lambda: client.get(_redeem_url(event, carts[1])))
+    assert r.status_code == 200
+
+
+@pytest.mark.django_db
+def test_redeem_template_post(client, env, record_property):
+    event, itemvars = env
+    carts = _create_templates(event, itemvars, 2)
+    client.post(_redeem_url(event, carts[0]))
+    r = _measure(record_property, 'redeem_template_post', lambda: client.post(_redeem_url(event, carts[1])))
+    assert 'checkout' in r['Location']
+
+
+@pytest.mark.django_db
+def test_delete(client, env, record_property):
+    event, itemvars = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    carts = list(SharedCart.objects.order_by('pk')[:2])
+    client.post(_control_url(event, '%s/delete' % carts[0].cart_id))
+    r = _measure(record_property, 'delete', lambda: client.post(_control_url(event, '%s/delete' % carts[1].cart_id)))
+    assert r.status_code == 302
+    assert SharedCart.objects.count() == CARTS - 2
+
+
+@pytest.mark.django_db
+def test_cleanup(env, record_property):
+    event, itemvars = env
+    SharedCart.objects.update(expires=now() - timedelta(days=1))
+    assert _measure(record_property, 'cleanup', lambda: clean_cart_positions(event)) == (CARTS, CARTS * 2)
+
+
+@pytest.mark.django_db
+def test_cleanup_idle(env, record_property):
+    event, itemvars = env
+    clean_cart_positions(None)
+    assert _measure(record_property, 'cleanup_idle', lambda: clean_cart_positions(None)) == (0, 0)
@@ -1,11 +1,24 @@
+import csv
+import io
+import json
 from datetime import timedelta
 from decimal import Decimal
 
 import pytest
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 from django_scopes import scopes_disabled
 from pretix.base.models import CartPosition, Event, Organizer, Team, User
+from pretix.base.services.cart import CartError, CartManager
+from pretix.base.services.locking import LockTimeoutException
+from pretix_cartshare import services
+from pretix_cartshare.exporters import export_csv
+from pretix_cartshare.forms import get_itemvar_choices
 from pretix_cartshare.models import SharedCart
+from pretix_cartshare.services import create_shared_carts
 from pretix_cartshare.signals import clean_cart_positions
 
 
@@ -97,6 +110,9 @@ def test_create_sharedcart_variation(client, env):
         assert len(cps) == 3
         assert all(cp.item == shirt for cp in cps)
         assert all(cp.price == Decimal('14') for cp in cps)
+        sc = SharedCart.objects.get()
+        assert sc.position_count == 3
+        assert sc.summary == '3x T-Shirt – Red'
 
 
 @pytest.mark.django_db
@@ -121,6 +137,37 @@ def test_create_sharedcart_quota_full(client, env):
         assert not CartPosition.objects.exists()
 
 
+@pytest.mark.django_db
+def test_create_sharedcart_template(client, env):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    with scopes_disabled():
+        q = event.quotas.create(size=1, name='Test')
+        q.items.add(ticket)
+    r = client.post('/control/event/%s/%s/cartshare/create/' % (event.slug, event.organizer.slug), {
+        'expires': (now() + timedelta(days=14)).strftime("%Y-%m-%d %H:%M:%S"),
+        'max_redemptions': '10',
+        'reserve_on_redemption': 'on',
+        'form-TOTAL_FORMS': '1',
+        'form-INITIAL_FORMS': '0',
+        'form-MIN_NUM_FORMS': '1',
+        'form-MAX_NUM_FORMS': '1000',
+        'form-0-count': '3',
+        'form-0-itemvar': ticket.id,
+        'form-0-price': ''
+    }, follow=True)
+    assert 'alert-success' in r.rendered_content
+    with scopes_disabled():
+        assert not CartPosition.objects.exists()
+        sc = SharedCart.objects.get()
+        assert not sc.reserved
+        assert sc.max_redemptions == 10
+        assert sc.position_count == 3
+        assert sc.total == Decimal('36')
+        line = sc.lines.get()
+        assert (line.item, line.count, line.price) == (ticket, 3, Decimal('12'))
+
+
 @pytest.mark.django_db
 def test_create_sharedcart_invalid(client, env):
     event, user, ticket = env
@@ -151,14 +198,68 @@ def test_list_sharedcart(client, env):
     assert sc2.cart_id not in r.rendered_content
 
 
+@pytest.mark.django_db
+def test_list_sharedcart_summary(client, env):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event,
+                              position_count=3, summary='2x Ticket, 1x T-Shirt')
+    client.get('/control/event/%s/%s/cartshare/' % (event.slug, event.organizer.slug))
+    with CaptureQueriesContext(connection) as ctx_one:
+        r = client.get('/control/event/%s/%s/cartshare/' % (event.slug, event.organizer.slug))
+    assert '3 positions' in r.rendered_content
+    assert '2x Ticket, 1x T-Shirt' in r.rendered_content
+    for i in range(10):
+        SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event,
+                                  position_count=1, summary='1x Ticket')
+    with CaptureQueriesContext(connection) as ctx_many:
+        client.get('/control/event/%s/%s/cartshare/' % (event.slug, event.organizer.slug))
+    assert len(ctx_many.captured_queries) == len(ctx_one.captured_queries)
+
+
+@pytest.mark.django_db
+def test_list_sharedcart_filter(client, env):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    cheap = SharedCart.objects.create(cart_id='abcCheap', total=Decimal('10'), expires=now() + timedelta(days=3),
+                                      event=event)
+    pricey = SharedCart.objects.create(cart_id='abcPricey', total=Decimal('100'), expires=now() + timedelta(days=30),
+                                       event=event)
+    other = SharedCart.objects.create(cart_id='xyzOther', total=Decimal('50'), expires=now() + timedelta(days=3),
+                                      event=event)
+    url = '/control/event/%s/%s/cartshare/' % (event.slug, event.organizer.slug)
+
+    def listed(**params):
+        content = client.get(url, params).rendered_content
+        return {sc.cart_id for sc in (cheap, pricey, other) if sc.cart_id in content}
+
+    assert listed(query='abc') == {cheap.cart_id, pricey.cart_id}
+    assert listed(total_min='20', total_max='80') == {other.cart_id}
+    assert listed(expires_from=(now() + timedelta(days=10)).date().isoformat()) == {pricey.cart_id}
+    assert listed(created_until=(now() - timedelta(days=1)).date().isoformat()) == set()
+    assert 'No carts match your filter.' in client.get(url, {'query': 'nothing'}).rendered_content
+
+
+@pytest.mark.django_db
+def test_list_sharedcart_no_count(client, env):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    for i in range(30):
+        SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
+    with CaptureQueriesContext(connection) as ctx:
+        r = client.get('/control/event/%s/%s/cartshare/' % (event.slug, event.organizer.slug))
+    assert r.context['page_obj'].has_next()
+    assert not [q for q in ctx.captured_queries if 'COUNT(' in q['sql'] and 'pretix_cartshare_sharedcart' in q['sql']]
+
+
 @pytest.mark.django_db
 def test_delete_sharedcart(client, env):
     event, user, ticket = env
     client.login(email='dummy@dummy.dummy', password='dummy')
     sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
     with scopes_disabled():
-        CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
-                                    expires=now() + timedelta(days=3))
+        sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
+                                                          expires=now() + timedelta(days=3)))
     r = client.post('/control/event/%s/%s/cartshare/%s/delete' % (event.slug, event.organizer.slug, sc.cart_id), {},
                     follow=True)
     assert not SharedCart.objects.exists()
@@ -189,16 +290,676 @@ def test_require_permission(client, env):
     assert b'cartshare' not in r.content
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize('locking,same_quota,blocked', [
+    (None, True, True),
+    (None, False, True),
+    ('event', True, True),
+    ('quota', False, False),
+    # pretix does not lock quota rows, so checkouts on the same quota are not serialized and may oversell it
+    ('quota', True, False),
+])
+def test_create_lock_against_checkout(settings, monkeypatch, env, locking, same_quota, blocked):
+    if locking:
+        settings.CARTSHARE_LOCKING = locking
+    event, user, ticket = env
+    event.live = True
+    event.save()
+    with scopes_disabled():
+        event.quotas.create(size=5, name='Tickets').items.add(ticket)
+        other = event.items.create(default_price=Decimal('5'), name='Parking')
+        event.quotas.create(size=5, name='Parking').items.add(other)
+
+    checkouts = []
+    check_quotas = services._check_quotas
+
+    def checkout_during_create(quotas):
+        # A customer buys a product while the shared cart is being created
+        cm = CartManager(event=Event.objects.get(pk=event.pk), cart_id='customer')
+        cm.add_new_items([{'item': ticket.pk if same_quota else other.pk, 'variation': None, 'count': 1}])
+        try:
+            cm.commit()
+        except LockTimeoutException:
+            checkouts.append('blocked')
+        else:
+            checkouts.append('done')
+        return check_quotas(quotas)
+
+    monkeypatch.setattr(services, '_check_quotas', checkout_during_create)
+    with scopes_disabled():
+        create_shared_carts(event, [(SharedCart(expires=now() + timedelta(days=3)), [(ticket, None, 2, None)])])
+        assert checkouts == ['blocked' if blocked else 'done']
+        assert CartPosition.objects.filter(cart_id='customer').count() == (0 if blocked else 1)
+        assert CartPosition.objects.filter(item=ticket).exclude(cart_id='customer').count() == 2
+
+
 @pytest.mark.django_db
 def test_cleanup(env):
     event, user, ticket = env
     sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
     sc2 = SharedCart.objects.create(total=Decimal('13'), expires=now() - timedelta(days=3), event=event)
     with scopes_disabled():
-        CartPosition.objects.create(cart_id=sc2.cart_id, event=event, price=Decimal('13'), item=ticket,
-                                    expires=now() - timedelta(days=3))
+        sc2.cart_positions.add(CartPosition.objects.create(cart_id=sc2.cart_id, event=event, price=Decimal('13'), item=ticket,
+                                                           expires=now() - timedelta(days=3)))
     clean_cart_positions(event)
     with scopes_disabled():
         assert SharedCart.objects.filter(id=sc.id).exists()
         assert not SharedCart.objects.filter(id=sc2.id).exists()
         assert not CartPosition.objects.exists()
+
+
+@pytest.mark.django_db
+def test_cleanup_chunked(env):
+    event, user, ticket = env
+    with scopes_disabled():
+        for i in range(5):
+            sc = SharedCart.objects.create(total=Decimal('13'), expires=now() - timedelta(days=3), event=event)
+            for j in range(2):
+                sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
+                                                                  expires=now() - timedelta(days=3)))
+        CartPosition.objects.create(cart_id='unrelated', event=event, price=Decimal('13'), item=ticket,
+                                    expires=now() + timedelta(days=3))
+    assert clean_cart_positions(event, chunk_size=2) == (5, 10)
+    with scopes_disabled():
+        assert not SharedCart.objects.exists()
+        assert CartPosition.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_cleanup_time_limit(env):
+    event, user, ticket = env
+    SharedCart.objects.create(total=Decimal('13'), expires=now() - timedelta(days=3), event=event)
+    assert clean_cart_positions(event, time_limit=0) == (0, 0)
+    assert SharedCart.objects.exists()
+
+
+@pytest.mark.django_db
+def test_cleanup_skipped_until_next_expiry(settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    event, user, ticket = env
+    sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
+    assert clean_cart_positions(None) == (0, 0)
+    with CaptureQueriesContext(connection) as ctx:
+        assert clean_cart_positions(None) == (0, 0)
+    assert len(ctx.captured_queries) == 0
+
+    # Changes that bypass the plugin are only noticed once the cached expiry date has passed
+    SharedCart.objects.filter(pk=sc.pk).update(expires=now() - timedelta(days=1))
+    assert clean_cart_positions(None) == (0, 0)
+    with scopes_disabled():
+        create_shared_carts(event, [(SharedCart(expires=now() + timedelta(days=1)), [(ticket, None, 1, None)])])
+    assert clean_cart_positions(None) == (1, 0)
+
+
+@pytest.mark.django_db
+def test_cleanup_bounded_chunks(settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    event, user, ticket = env
+    for i in range(5):
+        SharedCart.objects.create(total=Decimal('13'), expires=now() - timedelta(days=3), event=event)
+    assert clean_cart_positions(None, chunk_size=2, max_chunks=2) == (4, 0)
+    assert clean_cart_positions(None, chunk_size=2, max_chunks=2) == (1, 0)
+    assert not SharedCart.objects.exists()
+
+
+@pytest.mark.django_db
+def test_cleanup_releases_unopened(client, settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    event, user, ticket = env
+    event.live = True
+    event.save()
+    with scopes_disabled():
+        event.quotas.create(size=5, name='Test').items.add(ticket)
+        opened = SharedCart(expires=now() + timedelta(days=3), release_unopened_at=now() - timedelta(hours=1))
+        unopened = SharedCart(expires=now() + timedelta(days=3), release_unopened_at=now() - timedelta(hours=1))
+        later = SharedCart(expires=now() + timedelta(days=3), release_unopened_at=now() + timedelta(days=1))
+        create_shared_carts(event, [(sc, [(ticket, None, 1, None)]) for sc in (opened, unopened, later)])
+
+    r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, opened.cart_id))
+    assert r.status_code == 200
+    opened.refresh_from_db()
+    assert opened.opened
+
+    assert clean_cart_positions(None) == (0, 0)
+    unopened.refresh_from_db()
+    assert not unopened.reserved
+    assert unopened.max_redemptions == 1
+    with scopes_disabled():
+        assert [(line.item, line.count) for line in unopened.lines.all()] == [(ticket, 1)]
+        assert CartPosition.objects.count() == 2
+    assert SharedCart.objects.filter(reserved=True).count() == 2
+
+    # The next run is not due before the release date of the remaining unopened cart
+    assert cache.get('pretix_cartshare_next_expiry') == pytest.approx(later.release_unopened_at.timestamp())
+
+
+@pytest.mark.django_db
+def test_create_release_requires_reservation(client, env):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r = client.post('/control/event/%s/%s/cartshare/create/' % (event.slug, event.organizer.slug), {
+        'expires': (now() + timedelta(days=14)).strftime("%Y-%m-%d %H:%M:%S"),
+        'release_unopened_at': (now() + timedelta(days=2)).strftime("%Y-%m-%d %H:%M:%S"),
+        'reserve_on_redemption': 'on',
+        'form-TOTAL_FORMS': '1',
+        'form-INITIAL_FORMS': '0',
+        'form-MIN_NUM_FORMS': '1',
+        'form-MAX_NUM_FORMS': '1000',
+        'form-0-count': '1',
+        'form-0-itemvar': ticket.id,
+        'form-0-price': ''
+    })
+    assert r.status_code == 200
+    assert not SharedCart.objects.exists()
+
+
+def _post_lines(client, event, lines, **extra):
+    data = {
+        'expires': (now() + timedelta(days=14)).strftime("%Y-%m-%d %H:%M:%S"),
+        'form-TOTAL_FORMS': str(len(lines)),
+        'form-INITIAL_FORMS': '0',
+        'form-MIN_NUM_FORMS': '1',
+        'form-MAX_NUM_FORMS': '1000',
+    }
+    for i, (itemvar, count, price) in enumerate(lines):
+        data['form-%d-itemvar' % i] = itemvar
+        data['form-%d-count' % i] = count
+        data['form-%d-price' % i] = price
+    data.update(extra)
+    with CaptureQueriesContext(connection) as ctx:
+        r = client.post('/control/event/%s/%s/cartshare/create/' % (event.slug, event.organizer.slug), data)
+    return r, len(ctx.captured_queries)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('reserve_on_redemption', ['', 'on'])
+def test_create_sharedcart_invalid_count(client, env, reserve_on_redemption):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r, count = _post_lines(client, event, [(ticket.id, -3, '')], reserve_on_redemption=reserve_on_redemption)
+    assert r.status_code == 200
+    assert 'has-error' in r.rendered_content
+    assert not SharedCart.objects.exists()
+
+
+@pytest.mark.django_db
+def test_create_form_queries_constant(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        shirt = event.items.create(name='T-Shirt')
+        shirt.variations.create(value='Red')
+        shirt.variations.create(value='Blue')
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    _post_lines(client, event, [(ticket.id, 1, 'abc')])
+    r, count_one = _post_lines(client, event, [(ticket.id, 1, 'abc')])
+    assert r.status_code == 200
+    r, count_many = _post_lines(client, event, [(ticket.id, 1, 'abc')] * 30)
+    assert r.status_code == 200
+    assert count_many == count_one
+
+
+@pytest.mark.django_db
+def test_itemvar_choices_cache(settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    event, user, ticket = env
+    with scopes_disabled():
+        event = Event.objects.get(pk=event.pk)
+    assert get_itemvar_choices(event) == [(str(ticket.pk), str(ticket.name))]
+    with CaptureQueriesContext(connection) as ctx:
+        get_itemvar_choices(event)
+    assert len(ctx.captured_queries) == 0
+    with scopes_disabled():
+        shirt = event.items.create(name='T-Shirt')
+        red = shirt.variations.create(value='Red')
+    assert get_itemvar_choices(event) == [
+        (str(ticket.pk), str(ticket.name)),
+        ('%d-%d' % (shirt.pk, red.pk), 'T-Shirt – Red'),
+    ]
+
+
+@pytest.mark.django_db
+def test_create_page_loads_products_lazily(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        ticket.name = 'Early-bird'
+        ticket.save()
+        event.items.create(name='Workshop')
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r = client.get('/control/event/%s/%s/cartshare/create/' % (event.slug, event.organizer.slug))
+    assert r.status_code == 200
+    assert 'cartshare/create/itemvars/' in r.rendered_content
+    assert 'Early-bird' not in r.rendered_content
+    assert 'Workshop' not in r.rendered_content
+
+    r, count = _post_lines(client, event, [(ticket.id, 1, 'abc')])
+    assert r.status_code == 200
+    assert '<option value="%d" selected>Early-bird</option>' % ticket.pk in r.rendered_content
+    assert 'Workshop' not in r.rendered_content
+
+
+@pytest.mark.django_db
+def test_itemvar_search(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        shirt = event.items.create(name='T-Shirt')
+        red = shirt.variations.create(value='Red')
+        shirt.variations.create(value='Blue')
+        for i in range(25):
+            event.items.create(name='Workshop %d' % i)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    url = '/control/event/%s/%s/cartshare/create/itemvars/' % (event.slug, event.organizer.slug)
+
+    r = client.get(url, {'query': 'shirt red'})
+    assert r.json() == {
+        'results': [{'id': '%d-%d' % (shirt.pk, red.pk), 'text': 'T-Shirt – Red'}],
+        'pagination': {'more': False},
+    }
+
+    r = client.get(url, {'query': 'workshop'})
+    assert len(r.json()['results']) == 20
+    assert r.json()['pagination']['more']
+    r = client.get(url, {'query': 'workshop', 'page': '2'})
+    assert len(r.json()['results']) == 5
+    assert not r.json()['pagination']['more']
+
+
+@pytest.mark.django_db
+def test_create_sharedcart_subevent(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        event.has_subevents = True
+        event.save()
+        se1 = event.subevents.create(name='Day 1', date_from=now())
+        se2 = event.subevents.create(name='Day 2', date_from=now())
+        event.quotas.create(size=1, name='Day 1', subevent=se1).items.add(ticket)
+        event.quotas.create(size=5, name='Day 2', subevent=se2).items.add(ticket)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+
+    r, count = _post_lines(client, event, [(ticket.id, 2, '')])
+    assert r.status_code == 200
+    assert not SharedCart.objects.exists()
+
+    r, count = _post_lines(client, event, [(ticket.id, 2, '')], subevent=se1.pk)
+    assert r.status_code == 200
+    assert not SharedCart.objects.exists()
+
+    r, count = _post_lines(client, event, [(ticket.id, 2, '')], subevent=se2.pk)
+    assert r.status_code == 302
+    with scopes_disabled():
+        sc = SharedCart.objects.get()
+        assert sc.subevent == se2
+        assert [cp.subevent for cp in sc.cart_positions.all()] == [se2, se2]
+
+
+@pytest.mark.django_db
+def test_create_sharedcart_queries_constant(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        q = event.quotas.create(size=100, name='Test')
+        q.items.add(ticket)
+        shirt = event.items.create(name='T-Shirt', default_price=Decimal('20'))
+        shirt_red = shirt.variations.create(value='Red')
+        q.items.add(shirt)
+        q.variations.add(shirt_red)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    lines = [(ticket.id, 1, ''), ('%s-%s' % (shirt.id, shirt_red.id), 1, '')]
+    _post_lines(client, event, lines)
+    r, count_few = _post_lines(client, event, lines)
+    assert r.status_code == 302
+    r, count_many = _post_lines(client, event, lines * 15)
+    assert r.status_code == 302
+    assert count_many == count_few
+    with scopes_disabled():
+        assert CartPosition.objects.count() == 34
+
+
+@pytest.mark.django_db
+def test_create_sharedcart_quota_queries_constant(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        items = []
+        for i in range(10):
+            item = event.items.create(name='Workshop %d' % i, default_price=Decimal('20'))
+            event.quotas.create(size=10, name='Workshop %d' % i).items.add(item)
+            items.append(item)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    _post_lines(client, event, [(i.id, 1, '') for i in items])
+    r, count_one = _post_lines(client, event, [(items[0].id, 1, '')])
+    assert r.status_code == 302
+    r, count_all = _post_lines(client, event, [(i.id, 1, '') for i in items])
+    assert r.status_code == 302
+    assert count_all == count_one
+
+
+def _import(client, event, name, content, **extra):
+    return client.post('/control/event/%s/%s/cartshare/import/' % (event.slug, event.organizer.slug), dict(
+        expires=(now() + timedelta(days=14)).strftime("%Y-%m-%d %H:%M:%S"),
+        file=SimpleUploadedFile(name, content.encode()),
+        **extra
+    ))
+
+
+@pytest.mark.django_db
+def test_import_csv(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        shirt = event.items.create(name='T-Shirt', default_price=Decimal('20'))
+        shirt_red = shirt.variations.create(value='Red')
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r = _import(client, event, 'carts.csv', 'reference,item,variation,count,price\n'
+                                            'alice,{t},,2,\n'
+                                            'alice,{s},{v},1,15.00\n'
+                                            'bob,{t},,1,10\n'.format(t=ticket.pk, s=shirt.pk, v=shirt_red.pk))
+    assert r['Content-Type'] == 'text/csv'
+    rows = r.content.decode().strip().split('\r\n')
+    assert len(rows) == 3
+    with scopes_disabled():
+        assert SharedCart.objects.count() == 2
+        alice = SharedCart.objects.get(cart_id=rows[1].split(',')[1])
+        assert alice.total == Decimal('39.00')
+        assert alice.positions.count() == 3
+        assert CartPosition.objects.count() == 4
+    assert rows[1].startswith('alice,%s,39.00,http' % alice.cart_id)
+
+
+@pytest.mark.django_db
+def test_import_subevent(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        event.has_subevents = True
+        event.save()
+        se1 = event.subevents.create(name='Day 1', date_from=now())
+        se2 = event.subevents.create(name='Day 2', date_from=now())
+        event.quotas.create(size=1, name='Day 1', subevent=se1).items.add(ticket)
+        event.quotas.create(size=5, name='Day 2', subevent=se2).items.add(ticket)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    content = 'reference,item,count\nalice,{t},2\n'.format(t=ticket.pk)
+
+    r = _import(client, event, 'carts.csv', content)
+    assert r.status_code == 200
+    assert not SharedCart.objects.exists()
+
+    r = _import(client, event, 'carts.csv', content, subevent=se2.pk)
+    assert r['Content-Type'] == 'text/csv'
+    with scopes_disabled():
+        sc = SharedCart.objects.get()
+        assert sc.subevent == se2
+        assert [cp.subevent for cp in sc.positions] == [se2, se2]
+
+
+@pytest.mark.django_db
+def test_import_json_quota_aggregated(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        q = event.quotas.create(size=3, name='Test')
+        q.items.add(ticket)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r = _import(client, event, 'carts.json', json.dumps([
+        {'reference': 'alice', 'lines': [{'item': ticket.pk, 'count': 2}]},
+        {'reference': 'bob', 'lines': [{'item': ticket.pk, 'count': 2}]},
+    ]))
+    assert r.status_code == 200
+    assert 'alert-danger' in r.rendered_content
+    with scopes_disabled():
+        assert not SharedCart.objects.exists()
+        assert not CartPosition.objects.exists()
+
+
+@pytest.mark.django_db
+def test_import_invalid(client, env):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r = _import(client, event, 'carts.csv', 'reference,item,count\nalice,abc,1\n')
+    assert r.status_code == 200
+    assert 'invalid line' in r.rendered_content
+    assert not SharedCart.objects.exists()
+
+
+@pytest.mark.django_db
+def test_create_sharedcart_async(client, env, settings):
+    settings.CARTSHARE_ASYNC_THRESHOLD = 2
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r, count = _post_lines(client, event, [(ticket.id, 3, '14')])
+    assert r.status_code == 302
+    r = client.get(r['Location'])
+    assert 'alert-success' in r.rendered_content
+    with scopes_disabled():
+        sc = SharedCart.objects.get()
+        assert sc.cart_id in r.rendered_content
+        assert sc.total == Decimal('42.00')
+        assert CartPosition.objects.filter(cart_id=sc.cart_id, price=Decimal('14')).count() == 3
+
+
+@pytest.mark.django_db
+def test_create_sharedcart_async_subevent_deleted(env):
+    event, user, ticket = env
+    with scopes_disabled():
+        event.has_subevents = True
+        event.save()
+        se = event.subevents.create(name='Day 1', date_from=now())
+        se_id = se.pk
+        se.delete()
+    expires = (now() + timedelta(days=3)).isoformat()
+    result = services.create_shared_cart.apply(args=(event.pk, 'a' * 32, expires, [[ticket.pk, None, 1, None]]),
+                                               kwargs={'subevent': se_id})
+    with pytest.raises(CartError):
+        result.get()
+    assert not SharedCart.objects.exists()
+
+
+@pytest.mark.django_db
+def test_create_sharedcart_async_quota_full(client, env, settings):
+    settings.CARTSHARE_ASYNC_THRESHOLD = 2
+    event, user, ticket = env
+    with scopes_disabled():
+        event.quotas.create(size=2, name='Test').items.add(ticket)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r, count = _post_lines(client, event, [(ticket.id, 3, '')])
+    assert r.status_code == 302
+    assert r['Location'].endswith('/cartshare/create/')
+    r = client.get(r['Location'])
+    assert 'alert-danger' in r.rendered_content
+    assert 'Test' in r.rendered_content
+    with scopes_disabled():
+        assert not SharedCart.objects.exists()
+        assert not CartPosition.objects.exists()
+
+
+def _export(client, event, fmt='csv'):
+    r = client.get('/control/event/%s/%s/cartshare/export/?format=%s' % (event.slug, event.organizer.slug, fmt))
+    assert r.streaming
+    return b''.join(r.streaming_content).decode()
+
+
+@pytest.mark.django_db
+def test_export(client, env):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    with scopes_disabled():
+        for i in range(3):
+            sc = SharedCart.objects.create(total=Decimal('24'), expires=now() + timedelta(days=3), event=event)
+            for j in range(2):
+                sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('12'),
+                                                                  item=ticket, expires=sc.expires))
+        template = SharedCart.objects.create(total=Decimal('36'), expires=now() + timedelta(days=3), event=event,
+                                             reserved=False)
+        template.lines.create(item=ticket, count=3, price=Decimal('12'))
+
+    rows = list(csv.DictReader(io.StringIO(_export(client, event))))
+    assert len(rows) == 7
+    assert rows[-1]['cart_id'] == template.cart_id
+    assert rows[-1]['count'] == '3'
+    assert all(row['item'] == str(ticket.pk) and row['price'] == '12.00' for row in rows)
+
+    data = json.loads(_export(client, event, 'json'))
+    assert len(data) == 4
+    assert [len(c['positions']) for c in data] == [2, 2, 2, 0]
+    assert data[-1]['lines'] == [{'item': ticket.pk, 'variation': None, 'count': 3, 'price': '12.00'}]
+
+
+@pytest.mark.django_db
+def test_export_queries_chunked(env):
+    event, user, ticket = env
+    with scopes_disabled():
+        for i in range(5):
+            sc = SharedCart.objects.create(total=Decimal('12'), expires=now() + timedelta(days=3), event=event)
+            sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('12'),
+                                                              item=ticket, expires=sc.expires))
+    with CaptureQueriesContext(connection) as ctx:
+        assert len(list(export_csv(event, chunk_size=2))) == 6
+    # one query for the carts plus one for the positions of each of the three chunks
+    assert len(ctx.captured_queries) == 4
+
+
+def _availability(client, event, lines):
+    data = {
+        'form-TOTAL_FORMS': str(len(lines)),
+        'form-INITIAL_FORMS': '0',
+        'form-MIN_NUM_FORMS': '1',
+        'form-MAX_NUM_FORMS': '1000',
+    }
+    for i, (itemvar, count) in enumerate(lines):
+        data['form-%d-itemvar' % i] = itemvar
+        data['form-%d-count' % i] = count
+    return client.post(
+        '/control/event/%s/%s/cartshare/create/availability/' % (event.slug, event.organizer.slug), data
+    ).json()
+
+
+@pytest.mark.django_db
+def test_availability_preview(client, env):
+    event, user, ticket = env
+    with scopes_disabled():
+        event.quotas.create(size=2, name='Test').items.add(ticket)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    assert _availability(client, event, [(ticket.pk, 1), (ticket.pk, 1)]) == {
+        'sufficient': True,
+        'quotas': [{'name': 'Test', 'requested': 2, 'available': 2, 'sufficient': True}],
+    }
+    assert _availability(client, event, [(ticket.pk, 3), ('', '')]) == {
+        'sufficient': False,
+        'quotas': [{'name': 'Test', 'requested': 3, 'available': 2, 'sufficient': False}],
+    }
+
+
+@pytest.mark.django_db
+def test_availability_preview_cached(client, settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    event, user, ticket = env
+    with scopes_disabled():
+        q = event.quotas.create(size=2, name='Test')
+        q.items.add(ticket)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    _availability(client, event, [(ticket.pk, 1)])
+    with CaptureQueriesContext(connection) as ctx:
+        assert _availability(client, event, [(ticket.pk, 1)])['quotas'][0]['available'] == 2
+    assert not [q for q in ctx.captured_queries if 'pretixbase_cartposition' in q['sql']]
+
+
+def _bulk(client, event, carts, action, **extra):
+    data = {'action': action, 'cart': [sc.pk for sc in carts]}
+    data.update(extra)
+    return client.post('/control/event/%s/%s/cartshare/bulk/' % (event.slug, event.organizer.slug), data,
+                       follow=True)
+
+
+@pytest.fixture
+def bulk_carts(env):
+    event, user, ticket = env
+    with scopes_disabled():
+        event.quotas.create(size=10, name='Test').items.add(ticket)
+        carts = [SharedCart(expires=now() + timedelta(days=3)) for i in range(3)]
+        create_shared_carts(event, [(sc, [(ticket, None, 2, None)]) for sc in carts])
+    return carts
+
+
+@pytest.mark.django_db
+def test_bulk_delete(client, env, bulk_carts):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r = _bulk(client, event, bulk_carts[:2], 'delete')
+    assert 'delete <strong>2</strong> shared carts' in r.rendered_content
+    assert 'name="confirmed"' in r.rendered_content
+    assert 'name="cart" value="%d"' % bulk_carts[1].pk in r.rendered_content
+    assert SharedCart.objects.count() == 3
+    with scopes_disabled():
+        assert CartPosition.objects.count() == 6
+
+    r = _bulk(client, event, bulk_carts[:2], 'delete', confirmed='on')
+    assert 'alert-success' in r.rendered_content
+    with scopes_disabled():
+        assert list(SharedCart.objects.all()) == bulk_carts[2:]
+        assert CartPosition.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_bulk_extend(client, env, bulk_carts):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    expires = (now() + timedelta(days=30)).replace(microsecond=0)
+    with CaptureQueriesContext(connection) as ctx:
+        _bulk(client, event, bulk_carts[:2], 'extend', expires=expires.strftime("%Y-%m-%d %H:%M:%S"))
+    assert len([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "pretixbase_cartposition"')]) == 1
+    with scopes_disabled():
+        assert SharedCart.objects.filter(expires=expires).count() == 2
+        assert CartPosition.objects.filter(expires=expires).count() == 4
+        assert CartPosition.objects.exclude(expires=expires).count() == 2
+
+    r = _bulk(client, event, bulk_carts, 'extend')
+    assert 'alert-danger' in r.rendered_content
+
+
+@pytest.mark.django_db
+def test_bulk_release(client, env, bulk_carts):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    _bulk(client, event, bulk_carts[:1], 'release')
+    with scopes_disabled():
+        sc = SharedCart.objects.get(pk=bulk_carts[0].pk)
+        assert not sc.reserved
+        assert sc.max_redemptions == 1
+        assert [(line.item, line.count, line.price) for line in sc.lines.all()] == [(ticket, 2, Decimal('12'))]
+        assert not sc.positions.exists()
+        assert CartPosition.objects.count() == 4
+
+    r = client.post('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id))
+    assert 'checkout' in r['Location']
+    with scopes_disabled():
+        assert CartPosition.objects.count() == 6
+
+
+@pytest.mark.django_db
+def test_bulk_all_async(client, env, settings, bulk_carts):
+    settings.CARTSHARE_BULK_ASYNC_THRESHOLD = 2
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    r = _bulk(client, event, [], 'delete', all='on')
+    assert 'delete <strong>3</strong> shared carts' in r.rendered_content
+    assert SharedCart.objects.count() == 3
+    r = _bulk(client, event, [], 'delete', all='on', confirmed='on')
+    assert 'alert-success' in r.rendered_content
+    with scopes_disabled():
+        assert not SharedCart.objects.exists()
+        assert not CartPosition.objects.exists()
+
+
+@pytest.mark.django_db
+def test_bulk_all_filtered(client, env, settings, bulk_carts):
+    event, user, ticket = env
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    SharedCart.objects.filter(pk=bulk_carts[0].pk).update(total=Decimal('100'))
+    r = _bulk(client, event, [], 'delete', all='on', total_min='50')
+    assert 'delete <strong>1</strong> shared cart?' in r.rendered_content
+    assert 'name="total_min" value="50"' in r.rendered_content
+    assert SharedCart.objects.count() == 3
+    _bulk(client, event, [], 'delete', all='on', total_min='50', confirmed='on')
+    assert list(SharedCart.objects.order_by('pk')) == bulk_carts[1:]
+
+    settings.CARTSHARE_BULK_ASYNC_THRESHOLD = 1
+    SharedCart.objects.filter(pk=bulk_carts[1].pk).update(total=Decimal('100'))
+    _bulk(client, event, [], 'delete', all='on', total_min='50', confirmed='on')
+    assert list(SharedCart.objects.all()) == bulk_carts[2:]
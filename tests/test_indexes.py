@@ -0,0 +1,54 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Organizer
+from pretix_cartshare.models import SharedCart
+
+
+@pytest.fixture
+@scopes_disabled()
+def event():
+    o = Organizer.objects.create(name='Dummy', slug='dummy')
+    event = Event.objects.create(
+        organizer=o, name='Dummy', slug='dummy',
+        date_from=now(), plugins='pretix_cartshare'
+    )
+    for i in range(20):
+        SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=i - 10), event=event)
+    return event
+
+
+def _plan(qs):
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+    return qs.explain()
+
+
+@pytest.mark.django_db
+def test_list_query_uses_index(event):
+    qs = SharedCart.objects.filter(event=event, expires__gte=now()).order_by('-datetime')
+    assert 'cartshare_event_expires_idx' in _plan(qs)
+
+
+@pytest.mark.django_db
+def test_cleanup_query_uses_index(event):
+    qs = SharedCart.objects.filter(expires__lt=now()).order_by('expires', 'pk')
+    assert 'cartshare_expires_idx' in _plan(qs)
+
+
+@pytest.mark.django_db
+def test_redeem_query_uses_index(event):
+    qs = SharedCart.objects.filter(event=event, cart_id='abc', expires__gte=now())
+    assert 'INDEX' in _plan(qs).upper()
+
+
+@pytest.mark.django_db
+def test_search_queries_use_index(event):
+    base = SharedCart.objects.filter(event=event, expires__gte=now())
+    assert 'cartshare_event_total_idx' in _plan(base.filter(total__gte=Decimal('100'), total__lte=Decimal('200')))
+    assert 'cartshare_event_datetime_idx' in _plan(base.filter(datetime__gte=now() - timedelta(days=1)))
@@ -0,0 +1,85 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+from django.test import Client
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Organizer
+from pretix.base.services.cart import CartError
+from pretix_cartshare.metrics import cartshare_timing, measure
+from pretix_cartshare.models import SharedCart
+from pretix_cartshare.services import create_shared_carts
+from pretix_cartshare.signals import clean_cart_positions
+
+
+@pytest.fixture
+@scopes_disabled()
+def env():
+    o = Organizer.objects.create(name='Dummy', slug='dummy')
+    event = Event.objects.create(
+        organizer=o, name='Dummy', slug='dummy', live=True,
+        date_from=now(), plugins='pretix_cartshare'
+    )
+    ticket = event.items.create(default_price=Decimal('12'), name='Early-bird')
+    event.quotas.create(size=10, name='Test').items.add(ticket)
+    return event, ticket
+
+
+@pytest.fixture
+def timings():
+    received = []
+
+    def receiver(sender, operation, phase, duration, queries, **kwargs):
+        received.append((sender, operation, phase, duration, queries))
+
+    cartshare_timing.connect(receiver)
+    yield received
+    cartshare_timing.disconnect(receiver)
+
+
+@pytest.mark.django_db
+def test_create_and_redeem_timings(env, timings):
+    event, ticket = env
+    sc = SharedCart(expires=now() + timedelta(days=3))
+    with scopes_disabled():
+        create_shared_carts(event, [(sc, [(ticket, None, 2, None)])])
+    phases = {phase: (sender, queries) for sender, operation, phase, duration, queries in timings
+              if operation == 'create'}
+    assert set(phases) == {'quota_precheck', 'lock_wait', 'lock_held', 'quota_check', 'bulk_insert'}
+    assert all(sender == event for sender, queries in phases.values())
+    assert phases['bulk_insert'][1] >= 3
+    assert phases['lock_held'][1] >= phases['quota_check'][1] + phases['bulk_insert'][1]
+
+    timings.clear()
+    r = Client().post('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id))
+    assert 'checkout' in r['Location']
+    assert [(operation, phase) for sender, operation, phase, duration, queries in timings] == [('redeem', 'post')]
+    assert timings[0][4] > 0
+
+
+@pytest.mark.django_db
+def test_create_sold_out_skips_lock(env, timings):
+    event, ticket = env
+    with scopes_disabled():
+        with pytest.raises(CartError):
+            create_shared_carts(event, [(SharedCart(expires=now() + timedelta(days=3)), [(ticket, None, 11, None)])])
+    assert [phase for sender, operation, phase, duration, queries in timings] == ['quota_precheck']
+
+
+@pytest.mark.django_db
+def test_cleanup_timings(env, timings):
+    event, ticket = env
+    with scopes_disabled():
+        create_shared_carts(event, [(SharedCart(expires=now() - timedelta(days=1)), [(ticket, None, 1, None)])])
+    timings.clear()
+    clean_cart_positions(None)
+    assert [(sender, operation, phase) for sender, operation, phase, duration, queries in timings] == [
+        (None, 'cleanup', 'chunk'), (None, 'cleanup', 'total'),
+    ]
+
+
+def test_no_overhead_without_receivers():
+    with measure('create', 'lock_held'):
+        assert not connection.execute_wrappers
@@ -1,11 +1,19 @@
+import threading
+import time
 from datetime import timedelta
 from decimal import Decimal
 
 import pytest
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 from django_scopes import scopes_disabled
-from pretix.base.models import CartPosition, Event, Organizer
+from pretix.base.models import CartPosition, Event, GiftCard, Organizer
 from pretix_cartshare.models import SharedCart
+from pretix_cartshare.services import create_shared_carts, release_shared_carts
+from pretix_cartshare.views import RedeemView
 
 
 @pytest.fixture
@@ -25,8 +33,8 @@ def test_redeem_expired(client, env):
     event, ticket = env
     sc = SharedCart.objects.create(total=Decimal('13'), expires=now() - timedelta(days=3), event=event)
     with scopes_disabled():
-        CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
-                                    expires=now() - timedelta(days=3))
+        sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
+                                                          expires=now() - timedelta(days=3)))
     r = client.post('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id), {})
     assert r.status_code == 404
 
@@ -38,6 +46,7 @@ def test_redeem_valid(client, env):
     with scopes_disabled():
         cp = CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
                                          expires=now() + timedelta(days=3))
+        sc.cart_positions.add(cp)
     r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id))
     assert r.status_code == 200
     assert 'Early-bird' in r.rendered_content
@@ -48,3 +57,288 @@ def test_redeem_valid(client, env):
     cp.refresh_from_db()
     assert cp.cart_id != sc.cart_id
     assert cp.expires < now() + timedelta(days=1)
+
+
+@pytest.mark.django_db
+def test_redeem_already_claimed(client, env, monkeypatch):
+    event, ticket = env
+    sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
+    with scopes_disabled():
+        cp = CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
+                                         expires=now() + timedelta(days=3))
+        sc.cart_positions.add(cp)
+    monkeypatch.setattr(RedeemView, 'object', SharedCart.objects.get(pk=sc.pk))
+    SharedCart.objects.filter(pk=sc.pk).delete()
+    r = client.post('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id), {}, follow=True)
+    assert r.status_code == 200
+    assert 'already been redeemed' in r.rendered_content
+    cp.refresh_from_db()
+    assert cp.cart_id == sc.cart_id
+
+
+@pytest.mark.django_db
+def test_redeem_released_meanwhile(client, env, monkeypatch):
+    event, ticket = env
+    with scopes_disabled():
+        event.quotas.create(size=10, name='Test').items.add(ticket)
+        sc = SharedCart(expires=now() + timedelta(days=3))
+        create_shared_carts(event, [(sc, [(ticket, None, 2, None)])])
+    monkeypatch.setattr(RedeemView, 'object', SharedCart.objects.get(pk=sc.pk))
+    with scopes_disabled():
+        release_shared_carts(SharedCart.objects.filter(pk=sc.pk))
+    r = client.post('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id), {})
+    assert 'checkout' in r['Location']
+    with scopes_disabled():
+        cps = list(CartPosition.objects.all())
+    assert len(cps) == 2
+    assert all(cp.cart_id != sc.cart_id for cp in cps)
+    assert SharedCart.objects.get(pk=sc.pk).redemptions == 1
+
+
+@pytest.mark.django_db
+def test_redeem_positions_gone(client, env):
+    event, ticket = env
+    sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
+    with scopes_disabled():
+        sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'),
+                                                          item=ticket, expires=now() + timedelta(days=3)))
+        CartPosition.objects.all().delete()
+    r = client.post('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id), {}, follow=True)
+    assert r.status_code == 200
+    assert 'no longer reserved' in r.rendered_content
+    assert SharedCart.objects.filter(pk=sc.pk).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_redeem_concurrent(env):
+    event, ticket = env
+    sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
+    with scopes_disabled():
+        for i in range(3):
+            sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
+                                                              expires=now() + timedelta(days=3)))
+
+    barrier = threading.Barrier(8)
+    results = []
+
+    def retry_locked(execute, sql, params, many, context):
+        # SQLite's shared in-memory test database reports concurrent writes as an error instead of waiting
+        for i in range(100):
+            try:
+                return execute(sql, params, many, context)
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                time.sleep(.01)
+        return execute(sql, params, many, context)
+
+    def redeem():
+        client = Client()
+        try:
+            with connection.execute_wrapper(retry_locked):
+                barrier.wait()
+                r = client.post('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id), {})
+                results.append(r)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=redeem) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(results) == 8
+    winners = [r for r in results if r.status_code == 302 and 'checkout' in r['Location']]
+    assert len(winners) == 1
+    assert all(r.status_code in (302, 404) for r in results)
+    with scopes_disabled():
+        assert not SharedCart.objects.exists()
+        cart_ids = set(CartPosition.objects.values_list('cart_id', flat=True))
+        assert len(cart_ids) == 1
+        assert sc.cart_id not in cart_ids
+
+
+def _create_template(event, ticket, count=2, max_redemptions=None):
+    sc = SharedCart(expires=now() + timedelta(days=3), reserved=False, max_redemptions=max_redemptions)
+    with scopes_disabled():
+        create_shared_carts(event, [(sc, [(ticket, None, count, None)])])
+    return sc
+
+
+@pytest.mark.django_db
+def test_redeem_template(env):
+    event, ticket = env
+    with scopes_disabled():
+        q = event.quotas.create(size=10, name='Test')
+        q.items.add(ticket)
+    sc = _create_template(event, ticket, max_redemptions=2)
+    with scopes_disabled():
+        assert not CartPosition.objects.exists()
+    url = '/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id)
+
+    clients = [Client() for i in range(3)]
+    assert 'Early-bird' in clients[0].get(url).rendered_content
+    for client in clients[:2]:
+        r = client.post(url, {})
+        assert 'checkout' in r['Location']
+    assert clients[2].post(url, {}).status_code == 404
+
+    with scopes_disabled():
+        assert CartPosition.objects.count() == 4
+        assert len(set(CartPosition.objects.values_list('cart_id', flat=True))) == 2
+        sc.refresh_from_db()
+        assert sc.redemptions == 2
+
+
+@pytest.mark.django_db
+def test_redeem_template_quota(client, env):
+    event, ticket = env
+    with scopes_disabled():
+        q = event.quotas.create(size=1, name='Test')
+        q.items.add(ticket)
+    sc = _create_template(event, ticket)
+    r = client.post('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id), {}, follow=True)
+    assert 'does not have enough capacity' in r.rendered_content
+    with scopes_disabled():
+        assert not CartPosition.objects.exists()
+        sc.refresh_from_db()
+        assert sc.redemptions == 0
+
+
+def _sharedcart_queries(ctx):
+    return [q for q in ctx.captured_queries if 'pretix_cartshare_sharedcart' in q['sql']]
+
+
+@pytest.mark.django_db
+def test_redeem_preview_cached(client, settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    event, ticket = env
+    sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
+    with scopes_disabled():
+        sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
+                                                          expires=now() + timedelta(days=3)))
+    url = '/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id)
+    r = client.get(url)
+    assert 'Early-bird' in r.rendered_content
+    with CaptureQueriesContext(connection) as ctx:
+        r = client.get(url)
+    assert 'Early-bird' in r.rendered_content
+    assert not _sharedcart_queries(ctx)
+
+    client.post(url, {})
+    r = client.get(url)
+    assert r.status_code == 404
+
+
+@pytest.mark.django_db
+def test_redeem_preview_cached_without_visitor_fees(settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    event, ticket = env
+    sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
+    with scopes_disabled():
+        sc.cart_positions.add(CartPosition.objects.create(cart_id=sc.cart_id, event=event, price=Decimal('13'), item=ticket,
+                                                          expires=now() + timedelta(days=3)))
+        gc = GiftCard.objects.create(issuer=event.organizer, currency=event.currency, secret='VISITORAGIFTCARD')
+        gc.transactions.create(value=Decimal('5'))
+    url = '/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id)
+
+    # The first visitor has applied a gift card in their cart session
+    first = Client()
+    session = first.session
+    session['current_cart_event_%d' % event.pk] = 'first-visitor'
+    session['carts'] = {'first-visitor': {'gift_cards': [gc.pk]}}
+    session.save()
+    second = Client()
+
+    for client in (first, second):
+        r = client.get(url)
+        assert r.status_code == 200
+        assert 'Early-bird' in r.rendered_content
+        assert 'VISITORAGIFTCARD' not in r.rendered_content
+        assert '8.00' not in r.rendered_content
+
+
+@pytest.mark.django_db
+def test_redeem_preview_missing_cached(client, settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    event, ticket = env
+    url = '/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, 'a' * 32)
+    assert client.get(url).status_code == 404
+    with CaptureQueriesContext(connection) as ctx:
+        assert client.get(url).status_code == 404
+    assert not _sharedcart_queries(ctx)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('cart_id', ['a' * 11, 'a' * 33, 'a' * 31 + '-', 'a' * 31 + 'ä'])
+def test_redeem_malformed_id(client, settings, env, cart_id):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    event, ticket = env
+    url = '/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, cart_id)
+    with CaptureQueriesContext(connection) as ctx:
+        assert client.get(url).status_code == 404
+    assert not _sharedcart_queries(ctx)
+    assert not cache.get('cartshare_redeem_bucket_127.0.0.1')
+
+
+@pytest.mark.django_db
+def test_redeem_rate_limited(client, settings, monkeypatch, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    settings.CARTSHARE_REDEEM_RATE_LIMIT_BURST = 3
+    settings.CARTSHARE_REDEEM_RATE_LIMIT_REFILL = 0.5
+    cache.clear()
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    event, ticket = env
+    sc = SharedCart.objects.create(total=Decimal('13'), expires=now() + timedelta(days=3), event=event)
+
+    for i in range(3):
+        r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, '%032d' % i))
+        assert r.status_code == 404
+    with CaptureQueriesContext(connection) as ctx:
+        r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id))
+    assert r.status_code == 429
+    assert r['Retry-After'] == '2'
+    assert not _sharedcart_queries(ctx)
+
+    r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id),
+                   REMOTE_ADDR='10.0.0.1')
+    assert r.status_code == 200
+
+    clock[0] += 2
+    r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id))
+    assert r.status_code == 200
+    r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, sc.cart_id))
+    assert r.status_code == 200
+
+
+@pytest.mark.django_db
+def test_redeem_rate_limit_no_refill(client, settings, monkeypatch, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    settings.CARTSHARE_REDEEM_RATE_LIMIT_BURST = 2
+    settings.CARTSHARE_REDEEM_RATE_LIMIT_REFILL = 0
+    cache.clear()
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    event, ticket = env
+    for i in range(2):
+        r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, '%032d' % i))
+        assert r.status_code == 404
+    clock[0] += 600
+    r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, 'a' * 32))
+    assert r.status_code == 429
+    assert r['Retry-After'] == '3000'
+
+
+@pytest.mark.django_db
+def test_redeem_rate_limit_disabled(client, settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    settings.CARTSHARE_REDEEM_RATE_LIMIT_BURST = None
+    cache.clear()
+    event, ticket = env
+    for i in range(30):
+        r = client.get('/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, '%032d' % i))
+        assert r.status_code == 404
@@ -0,0 +1,103 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Organizer, Team, User
+from pretix_cartshare.models import (
+    SharedCart, SharedCartCounter, SharedCartLogEntry,
+)
+from pretix_cartshare.services import create_shared_carts
+from pretix_cartshare.signals import (
+    LOG_AGGREGATION_LOCK_KEY, aggregate_log_entries, clean_cart_positions,
+)
+
+
+@pytest.fixture
+@scopes_disabled()
+def env():
+    o = Organizer.objects.create(name='Dummy', slug='dummy')
+    event = Event.objects.create(
+        organizer=o, name='Dummy', slug='dummy', live=True,
+        date_from=now(), plugins='pretix_cartshare'
+    )
+    user = User.objects.create_user('dummy@dummy.dummy', 'dummy')
+    t = Team.objects.create(organizer=o, can_change_orders=True, can_view_orders=True)
+    t.members.add(user)
+    t.limit_events.add(event)
+    ticket = event.items.create(default_price=Decimal('12'), name='Early-bird')
+    event.quotas.create(size=10, name='Test').items.add(ticket)
+    return event, ticket
+
+
+def _age_log():
+    SharedCartLogEntry.objects.update(datetime=now() - timedelta(minutes=5))
+
+
+@pytest.mark.django_db
+def test_log_and_aggregate(client, env):
+    event, ticket = env
+    carts = [SharedCart(expires=now() + timedelta(days=3)) for i in range(3)]
+    with scopes_disabled():
+        create_shared_carts(event, [(sc, [(ticket, None, 1, None)]) for sc in carts])
+
+    url = '/%s/%s/sharedcart/%s/' % (event.slug, event.organizer.slug, carts[0].cart_id)
+    client.get(url)
+    client.get(url)
+    client.post(url)
+    SharedCart.objects.filter(pk=carts[1].pk).update(expires=now() - timedelta(days=1))
+    clean_cart_positions(None)
+
+    assert list(SharedCartLogEntry.objects.order_by('pk').values_list('cart_id', 'action')) == [
+        (carts[0].cart_id, 'created'), (carts[1].cart_id, 'created'), (carts[2].cart_id, 'created'),
+        (carts[0].cart_id, 'viewed'), (carts[0].cart_id, 'redeemed'), (carts[1].cart_id, 'expired'),
+    ]
+
+    # Entries are only counted once they are old enough
+    assert aggregate_log_entries(None) == 0
+    _age_log()
+    assert aggregate_log_entries(None) == 6
+    assert aggregate_log_entries(None) == 0
+
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    client.post('/control/event/%s/%s/cartshare/%s/delete' % (event.slug, event.organizer.slug, carts[2].cart_id))
+    _age_log()
+    assert aggregate_log_entries(None) == 1
+    assert dict(SharedCartCounter.objects.filter(event=event).values_list('action', 'count')) == {
+        'created': 3, 'viewed': 1, 'redeemed': 1, 'expired': 1, 'deleted': 1,
+    }
+
+
+@pytest.mark.django_db
+def test_aggregate_skipped_while_locked(settings, env):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    event, ticket = env
+    with scopes_disabled():
+        create_shared_carts(event, [(SharedCart(expires=now() + timedelta(days=3)), [(ticket, None, 1, None)])])
+    _age_log()
+
+    cache.add(LOG_AGGREGATION_LOCK_KEY, True)
+    assert aggregate_log_entries(None) == 0
+    assert not SharedCartCounter.objects.exists()
+    cache.delete(LOG_AGGREGATION_LOCK_KEY)
+    assert aggregate_log_entries(None) == 1
+    assert SharedCartCounter.objects.get(event=event, action='created').count == 1
+    assert not cache.get(LOG_AGGREGATION_LOCK_KEY)
+
+
+@pytest.mark.django_db
+def test_stats_page(client, env):
+    event, ticket = env
+    SharedCartCounter.objects.create(event=event, action='created', count=8)
+    SharedCartCounter.objects.create(event=event, action='redeemed', count=2)
+    client.login(email='dummy@dummy.dummy', password='dummy')
+    url = '/control/event/%s/%s/cartshare/stats/' % (event.slug, event.organizer.slug)
+    client.get(url)
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r.context['rows'][0][1:] == (8, 100.0)
+    assert r.context['rows'][2][1:] == (2, 25.0)
+    assert r.context['rows'][1][1:] == (0, 0.0)